@@ -0,0 +1,106 @@
+# Fake DomoticzEx module for running the Wallbox plugin outside Domoticz
+#
+# Provides the logging functions, Unit and Device classes used by plugin.py.
+# Every Update, Touch and Create is recorded in `calls`, log output in `messages`.
+#
+import threading
+
+Devices = {}
+Parameters = {}
+messages = []          # (level, text)
+calls = []             # (action, DeviceID, Unit)
+debugging = 0
+heartbeat = 10
+echo = False           # Print log messages
+lock = threading.Lock()
+
+def reset():
+    global debugging, heartbeat
+    Devices.clear()
+    Parameters.clear()
+    with lock:
+        messages.clear()
+        calls.clear()
+    debugging = 0
+    heartbeat = 10
+
+def record(action, deviceID, unit):
+    with lock:
+        calls.append((action, deviceID, unit))
+
+def count(action):
+    with lock:
+        return sum(1 for call in calls if call[0] == action)
+
+def log(level, text):
+    with lock:
+        messages.append((level, text))
+    if echo:
+        print(f"{level}: {text}")
+
+def Debug(text):
+    log("Debug", text)
+
+def Log(text):
+    log("Log", text)
+
+def Status(text):
+    log("Status", text)
+
+def Error(text):
+    log("Error", text)
+
+def Debugging(level):
+    global debugging
+    debugging = level
+
+def Heartbeat(seconds):
+    global heartbeat
+    heartbeat = seconds
+
+class Device:
+    def __init__(self, DeviceID):
+        self.DeviceID = DeviceID
+        self.Units = {}
+        self.TimedOut = 0
+
+    def __str__(self):
+        return f"Device: {self.DeviceID}, Units: {len(self.Units)}"
+
+class Unit:
+    def __init__(self, Name="", DeviceID="", Unit=0, Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, Description=""):
+        self.Name = Name
+        self.DeviceID = DeviceID
+        self.Unit = Unit
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.Used = Used
+        self.Description = Description
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.TimedOut = 0
+        self.history = []   # (nValue, sValue) of every Update with Log=True
+
+    def Create(self):
+        device = Devices.setdefault(self.DeviceID, Device(self.DeviceID))
+        device.Units[self.Unit] = self
+        record("Create", self.DeviceID, self.Unit)
+
+    def Update(self, Log=False, TypeName="", UpdateProperties=False, UpdateOptions=False, SuppressTriggers=False):
+        if Log:
+            self.history.append((self.nValue, self.sValue))
+        record("Update", self.DeviceID, self.Unit)
+
+    def Touch(self):
+        record("Touch", self.DeviceID, self.Unit)
+
+    def Delete(self):
+        Devices[self.DeviceID].Units.pop(self.Unit, None)
+        record("Delete", self.DeviceID, self.Unit)
+
+    def __str__(self):
+        return f"Unit: {self.Unit}, Name: '{self.Name}', nValue: {self.nValue}, sValue: '{self.sValue}'"
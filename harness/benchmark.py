@@ -0,0 +1,140 @@
+# Offline benchmarks for the Wallbox plugin
+#
+# Runs plugin.py against the fake DomoticzEx module and the fake Wallbox client:
+#   python harness/benchmark.py --chargers 5 --sessions 10000 --latency 0.05
+#
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+harnessFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, harnessFolder)
+sys.path.insert(1, os.path.dirname(harnessFolder))
+
+import DomoticzEx
+from fakewallbox import FakeWallbox
+import plugin
+
+def setup(chargers, sessions, latency, homeFolder, debug="0", budget=60):
+    # Fresh fake Domoticz and plugin instance, the worker thread is not started
+    DomoticzEx.reset()
+    DomoticzEx.Parameters.update({
+        "Username": "bench@example.com",
+        "Password": "secret",
+        "HomeFolder": homeFolder + os.sep,
+        "Mode1": "6",
+        "Mode2": "03",
+        "Mode3": "00",
+        "Mode4": "0",
+        "Mode5": f"BUDGET:{budget}",
+        "Mode6": debug
+    })
+    plugin.Parameters = DomoticzEx.Parameters
+    plugin.Devices = DomoticzEx.Devices
+    plugin.setDebugLevel(int(debug))
+    fake = FakeWallbox(latency=latency)
+    for index in range(chargers):
+        fake.addCharger(100000 + index, sessions=sessions // chargers)
+    plugin.Wallbox = lambda username, password, **kwargs: fake
+    wbPlugin = plugin.WallboxPlugin()
+    wbPlugin.debugging = False
+    plugin._plugin = wbPlugin
+    return wbPlugin, fake
+
+def createDevices(wbPlugin, fake):
+    wbPlugin.wallbox = plugin.WallboxAuth(fake, wbPlugin.metrics)
+    wbPlugin.wallbox.login()
+    wbPlugin.chargerList = fake.getChargersList()
+    for chargerId in wbPlugin.chargerList:
+        wbPlugin.chargers[str(chargerId)] = plugin.ChargerState(chargerId)
+    wbPlugin.fillHistoricEnergyData = lambda chargerId, fullRebuild=False: None
+    for chargerId in wbPlugin.chargerList:
+        wbPlugin.initDevices(chargerId)
+        wbPlugin.pollScheduler.add(chargerId)
+    del wbPlugin.fillHistoricEnergyData
+
+def benchHistory(args, homeFolder):
+    wbPlugin, fake = setup(args.chargers, args.sessions, args.latency, homeFolder)
+    createDevices(wbPlugin, fake)
+    results = {}
+    for mode, fullRebuild in (("full", True), ("incremental", False)):
+        updates = DomoticzEx.count("Update")
+        tracemalloc.start()
+        start = time.perf_counter()
+        for chargerId in wbPlugin.chargerList:
+            wbPlugin.fillHistoricEnergyData(chargerId, fullRebuild=fullRebuild)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[mode] = (elapsed, peak, DomoticzEx.count("Update") - updates)
+    return results
+
+def benchPolls(args, homeFolder):
+    wbPlugin, fake = setup(args.chargers, 0, args.latency, homeFolder)
+    createDevices(wbPlugin, fake)
+    chargerIds = [str(chargerId) for chargerId in wbPlugin.chargerList]
+    wbPlugin.pollPool = plugin.concurrent.futures.ThreadPoolExecutor(max_workers=min(wbPlugin.maxPollWorkers, len(chargerIds)))
+    times = []
+    updates = DomoticzEx.count("Update")
+    for poll in range(args.polls):
+        if poll == args.polls // 2:
+            # Half way a charger starts charging, so there is something to write
+            fake.resumeChargingSession(chargerIds[0])
+        start = time.perf_counter()
+        wbPlugin.pollChargers(chargerIds)
+        times.append(time.perf_counter() - start)
+    wbPlugin.pollPool.shutdown()
+    return times, (DomoticzEx.count("Update") - updates) / args.polls
+
+def benchCommands(args, homeFolder):
+    wbPlugin, fake = setup(args.chargers, args.sessions, args.latency, homeFolder, budget=args.budget)
+    plugin.onStart()
+    deadline = time.time() + 60
+    while time.time() < deadline and not any("Entering message handler" in text for level, text in DomoticzEx.messages):
+        time.sleep(0.01)
+    chargerId = str(wbPlugin.chargerList[0])
+    latencies = []
+    for command in range(args.commands):
+        unit, method = (3, "resumeChargingSession") if command % 2 == 0 else (4, "pauseChargingSession")
+        calls = fake.callCount(method)
+        start = time.perf_counter()
+        plugin.onCommand(chargerId, unit, "On", 0, None)
+        while fake.callCount(method) == calls and time.perf_counter() - start < 30:
+            time.sleep(0.001)
+        latencies.append(time.perf_counter() - start)
+    print(f"{'API budget':32} {wbPlugin.budget.stats()}")
+    plugin.onStop()
+    return latencies
+
+def report(name, values, unit="ms"):
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    print(f"{name:32} mean {statistics.mean(values) * 1000:9.2f} {unit}  p95 {p95 * 1000:9.2f} {unit}  max {values[-1] * 1000:9.2f} {unit}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline Wallbox plugin benchmarks")
+    parser.add_argument("--chargers", type=int, default=5)
+    parser.add_argument("--sessions", type=int, default=10000, help="Total sessions over all chargers")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake API latency in seconds")
+    parser.add_argument("--polls", type=int, default=100)
+    parser.add_argument("--commands", type=int, default=20)
+    parser.add_argument("--budget", type=int, default=60, help="API budget in requests per minute")
+    args = parser.parse_args()
+
+    print(f"Chargers: {args.chargers} Sessions: {args.sessions} API latency: {args.latency * 1000:.0f} ms")
+    with tempfile.TemporaryDirectory() as homeFolder:
+        for mode, (elapsed, peak, updates) in benchHistory(args, homeFolder).items():
+            print(f"fillHistoricEnergyData {mode:11} {elapsed * 1000:9.2f} ms  peak memory {peak / 1024:9.1f} KiB  Update calls {updates}")
+    with tempfile.TemporaryDirectory() as homeFolder:
+        times, updatesPerPoll = benchPolls(args, homeFolder)
+        report("poll all chargers", times)
+        print(f"{'Update calls per poll':32} {updatesPerPoll:.2f}")
+    with tempfile.TemporaryDirectory() as homeFolder:
+        report("command latency", benchCommands(args, homeFolder))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+# Scenario checks for the Wallbox plugin
+#
+# Runs parts of plugin.py against the fake DomoticzEx module and the fake Wallbox client
+# and prints ok or FAIL per check:
+#   python harness/checks.py
+#
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+
+harnessFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, harnessFolder)
+sys.path.insert(1, os.path.dirname(harnessFolder))
+
+import DomoticzEx
+import benchmark
+from fakewallbox import FakeWallbox
+import plugin
+
+def checkThrottledProbe():
+    # A half open probe refused by the budget must not leave the circuit half open
+    fake = FakeWallbox()
+    fake.addCharger(100000, sessions=5)
+    budget = plugin.ApiBudget()
+    wallbox = plugin.WallboxAuth(fake, budget=budget)
+    wallbox.login()
+    breaker = wallbox.breaker
+    breaker.state = breaker.OPEN
+    breaker.retryAt = time.time() - 1
+    budget.tokens = 0
+    checks = []
+    try:
+        wallbox.getSessionList(100000, datetime.datetime(2024, 1, 1), datetime.datetime.now())
+        throttled = False
+    except plugin.ThrottledError:
+        throttled = True
+    checks.append(("throttled probe refused", throttled))
+    checks.append(("throttled probe leaves circuit open", breaker.state == breaker.OPEN))
+    budget.tokens = budget.burst
+    try:
+        wallbox.getChargerStatus(100000)
+        polled = True
+    except plugin.CircuitOpenError:
+        polled = False
+    checks.append(("next call probes and closes circuit", polled and breaker.state == breaker.CLOSED))
+    return checks
+
+def checkTokenRefresh():
+    # Inside the refresh margin the token is really renewed, and only renewals count as login
+    checks = []
+    for drift in (0, plugin.WallboxAuth.refreshMargin):
+        fake = FakeWallbox(tokenLifetime=200, jwtTokenDrift=drift)
+        fake.addCharger(100000)
+        wallbox = plugin.WallboxAuth(fake, budget=plugin.ApiBudget())
+        wallbox.login()
+        tokens = {fake.jwtToken}
+        for poll in range(5):
+            wallbox.getChargerStatus(100000)
+            tokens.add(fake.jwtToken)
+        checks.append((f"token renewed in refresh margin, client drift {drift}", len(tokens) == 6))
+        checks.append((f"logins match real authentications, client drift {drift}", wallbox.logins == fake.callCount("authenticate") == 6))
+    return checks
+
+def addSession(fake, chargerId, sessionId, start, energy):
+    session = {
+        "type": "charger_log_session",
+        "id": sessionId,
+        "attributes": {"start": int(start), "end": int(start) + 3600, "energy": energy, "green_energy": 0.0}
+    }
+    fake.chargers[chargerId].sessions.insert(0, session)
+    return session
+
+def historyTotals(wbPlugin, fake, chargerId):
+    expected = sum(int(session["attributes"]["energy"] * 1000) for session in fake.chargers[chargerId].sessions)
+    store = plugin.SessionStore(plugin.Parameters["HomeFolder"], chargerId)
+    return expected, store["totalEnergy"], wbPlugin.sessions.totals(chargerId)[1]
+
+def checkRunningSession():
+    # A session that was still running gets its final energy, a session reported late is counted
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 20, 0, homeFolder)
+        benchmark.createDevices(wbPlugin, fake)
+        chargerId = wbPlugin.chargerList[0]
+        running = addSession(fake, chargerId, "running", time.time() - 600, 6.0)
+        wbPlugin.fillHistoricEnergyData(chargerId)
+        running["attributes"]["energy"] = 9.0
+        wbPlugin.fillHistoricEnergyData(chargerId)
+        expected, stored, database = historyTotals(wbPlugin, fake, chargerId)
+        checks.append(("running session final energy stored", expected == stored == database))
+        addSession(fake, chargerId, "late", time.time() - 3 * 3600, 2.0)
+        wbPlugin.fillHistoricEnergyData(chargerId)
+        expected, stored, database = historyTotals(wbPlugin, fake, chargerId)
+        checks.append(("late session counted", expected == stored == database))
+        wbPlugin.sessions.close()
+    return checks
+
+def checkLostDatabase():
+    # A new session database with an existing session store downloads all sessions again
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 50, 0, homeFolder)
+        benchmark.createDevices(wbPlugin, fake)
+        chargerId = wbPlugin.chargerList[0]
+        wbPlugin.fillHistoricEnergyData(chargerId)
+        wbPlugin.sessions.close()
+        os.remove(os.path.join(homeFolder, "sessions.db"))
+        wbPlugin.sessions = None
+        wbPlugin.fillHistoricEnergyData(chargerId)
+        expected, stored, database = historyTotals(wbPlugin, fake, chargerId)
+        checks.append(("lost session database downloaded again", expected == stored == database))
+        checks.append(("all sessions in new database", wbPlugin.sessions.totals(chargerId)[0] == 50))
+        wbPlugin.sessions.close()
+    return checks
+
+def checkThrottledRebuild():
+    # A full rebuild postponed by the API budget continues where it stopped and completes
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 200, 0, homeFolder, budget=300)
+        DomoticzEx.Parameters["Mode4"] = "1"
+        wbPlugin.throttleRetry = 0.2
+        startPlugin(wbPlugin)
+        chargerId = wbPlugin.chargerList[0]
+        store = lambda: plugin.SessionStore(homeFolder, chargerId)
+        done = waitFor(lambda: store()["sessionCount"] == 200, timeout=30)
+        throttled = wbPlugin.budget.throttled.get("backfill", 0)
+        checks.append(("rebuild throttled in the middle", throttled > 0))
+        checks.append(("throttled rebuild completes", done and wbPlugin.sessions.totals(chargerId)[0] == 200))
+        # 11 year windows until the first session, then 13 month windows, plus the retried ones
+        checks.append(("throttled rebuild does not start over", fake.callCount("getSessionList") <= 24 + throttled))
+        plugin.onStop()
+        DomoticzEx.Parameters["Mode4"] = "0"
+    return checks
+
+def startPlugin(wbPlugin):
+    plugin.onStart()
+    deadline = time.time() + 60
+    while time.time() < deadline and not any("Entering message handler" in text for level, text in DomoticzEx.messages):
+        time.sleep(0.01)
+
+def waitIdle(wbPlugin, timeout=10):
+    # Waits until the startup backfill and poll are done, so they cannot use an injected failure
+    return waitFor(lambda: not wbPlugin.messageQueue.unfinished and not wbPlugin.messageQueue.delayed, timeout)
+
+def waitFor(check, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.05)
+    return False
+
+async def connectRejected(url):
+    # True when the central system closes the connection with a policy violation
+    import websockets
+    async with websockets.connect(url, subprotocols=["ocpp1.6"]) as websocket:
+        try:
+            await websocket.recv()
+        except websockets.exceptions.ConnectionClosed as err:
+            return err.rcvd is not None and err.rcvd.code == 1008
+    return False
+
+def checkOcppCommand():
+    # Unknown and reserved charge point ids are rejected. A command sent over OCPP is reconciled
+    # from the charge point, without a cloud status request
+    import asyncio
+    from ocppchargepoint import SimulatedChargePoint
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 0, 0, homeFolder)
+        wbPlugin.commandSettleTime = 0.5
+        DomoticzEx.Parameters["Address"] = "127.0.0.1"
+        DomoticzEx.Parameters["Port"] = "9988"
+        startPlugin(wbPlugin)
+        for chargerId in ("200000", plugin.WallboxPlugin.DIAGNOSTICSID):
+            rejected = wbPlugin.ocpp.rejected
+            closed = asyncio.run(connectRejected(f"ws://127.0.0.1:9988/{chargerId}"))
+            checks.append((f"OCPP charge point {chargerId} rejected", closed and wbPlugin.ocpp.rejected == rejected + 1 and chargerId not in wbPlugin.chargers))
+        errors = len([text for level, text in DomoticzEx.messages if level == "Error"])
+        chargerId = str(wbPlugin.chargerList[0])
+        chargePoint = SimulatedChargePoint(f"ws://127.0.0.1:9988/{chargerId}", meterInterval=0.2)
+        threading.Thread(target=asyncio.run, args=(chargePoint.run(duration=6),), daemon=True).start()
+        connected = waitFor(lambda: wbPlugin.ocpp.isConnected(chargerId))
+        checks.append(("OCPP charge point of the account connected", connected))
+        if connected:
+            units = DomoticzEx.Devices[chargerId].Units
+            polls = fake.callCount("getChargerStatus")
+            plugin.onCommand(chargerId, wbPlugin.DEVICESTARTSTOP, "On", 0, None)
+            reconciled = waitFor(lambda: not wbPlugin.chargers[chargerId].pending and units[wbPlugin.DEVICESTARTSTOP].nValue == 1)
+            checks.append(("OCPP command reconciled from the charge point", reconciled))
+            newErrors = [text for level, text in DomoticzEx.messages if level == "Error"][errors:]
+            checks.append(("no cloud status request for OCPP charger", not newErrors and fake.callCount("getChargerStatus") == polls))
+            # Stop charging first, so the simulated meter values end before the server closes
+            plugin.onCommand(chargerId, wbPlugin.DEVICESTARTSTOP, "Off", 0, None)
+            waitFor(lambda: not wbPlugin.chargers[chargerId].pending and units[wbPlugin.DEVICESTARTSTOP].nValue == 0)
+        plugin.onStop()
+        DomoticzEx.Parameters["Address"] = ""
+        DomoticzEx.Parameters["Port"] = ""
+    return checks
+
+def checkFailedCommand():
+    # A failed command writes back the commanded unit and the status unit only
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 0, 0, homeFolder)
+        startPlugin(wbPlugin)
+        chargerId = str(wbPlugin.chargerList[0])
+        state = wbPlugin.chargers[chargerId]
+        waitFor(lambda: state.lastStatus is not None)
+        waitIdle(wbPlugin)
+        units = DomoticzEx.Devices[chargerId].Units
+        observed = []
+        observe = wbPlugin.pollScheduler.observe
+        wbPlugin.pollScheduler.observe = lambda chargerId, statusName: observed.append(statusName) or observe(chargerId, statusName)
+        updates = DomoticzEx.count("Update")
+        fake.failures = {"lockCharger": [500]}
+        plugin.onCommand(chargerId, wbPlugin.DEVICELOCK, "On", 0, None)
+        checks.append(("optimistic lock", units[wbPlugin.DEVICELOCK].nValue == 1 and units[wbPlugin.DEVICESTATUS].sValue.endswith(wbPlugin.pendingSuffix)))
+        waitFor(lambda: not state.pending)
+        checks.append(("failed lock rolled back", units[wbPlugin.DEVICELOCK].nValue == 0 and units[wbPlugin.DEVICESTATUS].sValue == "Ready"))
+        checks.append(("rollback writes two units only", DomoticzEx.count("Update") - updates == 4 and not observed))
+        plugin.onStop()
+    return checks
+
+def checkFailedSetpoint():
+    # A setpoint whose write failed is written again when it is requested again
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 0, 0, homeFolder)
+        wbPlugin.setpointWriter.debounce = 0.1
+        startPlugin(wbPlugin)
+        chargerId = str(wbPlugin.chargerList[0])
+        waitFor(lambda: wbPlugin.chargers[chargerId].lastStatus is not None)
+        waitIdle(wbPlugin)
+        fake.failures = {"setMaxChargingCurrent": [500]}
+        plugin.onCommand(chargerId, wbPlugin.DEVICESELECTHARGINGCURRENT, "Set Level", 20, None)
+        waitFor(lambda: fake.callCount("setMaxChargingCurrent") == 1)
+        plugin.onCommand(chargerId, wbPlugin.DEVICESELECTHARGINGCURRENT, "Set Level", 20, None)
+        written = waitFor(lambda: fake.chargers[int(chargerId)].maxChargingCurrent == 20)
+        checks.append(("failed setpoint written on the next request", written and fake.callCount("setMaxChargingCurrent") == 2))
+        plugin.onStop()
+    return checks
+
+def checkDiscoveredUpdate():
+    # The update queued for a discovered charger is merged with one already queued for it
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 0, 0, homeFolder)
+        benchmark.createDevices(wbPlugin, fake)
+        fake.addCharger(100001)
+        wbPlugin.messageQueue.put({"Type":"Update", "DeviceID": "100001"})
+        wbPlugin.discoverChargers()
+        checks.append(("update of discovered charger merged", wbPlugin.messageQueue.coalesced == 1))
+        if wbPlugin.pollPool is not None:
+            wbPlugin.pollPool.shutdown()
+    return checks
+
+def checkDepartedCharger():
+    # A charger removed from the account is no longer polled, and a 403 for one charger leaves the circuit closed
+    checks = []
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(2, 0, 0, homeFolder)
+        benchmark.createDevices(wbPlugin, fake)
+        del fake.chargers[100001]
+        wbPlugin.discoverChargers()
+        units = DomoticzEx.Devices["100001"].Units.values()
+        checks.append(("departed charger no longer polled", "100001" not in wbPlugin.pollScheduler.chargers and "100001" not in wbPlugin.chargers))
+        checks.append(("departed charger devices timed out", all(unit.TimedOut for unit in units)))
+        fake.failures = {"getChargerStatus": [403] * 5}
+        for poll in range(5):
+            try:
+                wbPlugin.wallbox.getChargerStatus(100001)
+            except Exception:
+                pass
+        checks.append(("403 for one charger leaves the circuit closed", not wbPlugin.wallbox.breaker.isOpen()))
+        if wbPlugin.pollPool is not None:
+            wbPlugin.pollPool.shutdown()
+    return checks
+
+def checkStop():
+    # onStop fails requests in flight right away and only waits for the threads of the plugin
+    import http.server
+    checks = []
+
+    class SlowHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(5)
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    transport = plugin.HttpTransport()
+    errors = []
+    def slowRequest():
+        try:
+            transport.get(f"http://127.0.0.1:{server.server_port}/")
+        except Exception as err:
+            errors.append(err)
+    request = threading.Thread(target=slowRequest)
+    request.start()
+    time.sleep(0.3)
+    start = time.time()
+    transport.abort()
+    request.join(5)
+    checks.append(("request in flight fails on abort", not request.is_alive() and errors and time.time() - start < 1))
+    server.shutdown()
+
+    with tempfile.TemporaryDirectory() as homeFolder:
+        wbPlugin, fake = benchmark.setup(1, 0, 0, homeFolder)
+        startPlugin(wbPlugin)
+        waitFor(lambda: not wbPlugin.messageQueue.unfinished)
+        foreign = threading.Thread(name="pydevd.Reader", target=time.sleep, args=(5,), daemon=True)
+        foreign.start()
+        start = time.time()
+        plugin.onStop()
+        stopped = time.time() - start
+        running = [text for level, text in DomoticzEx.messages if "Threads still running" in text]
+        checks.append(("onStop does not wait for foreign threads", stopped < 1 and not running))
+    return checks
+
+def checkMetricsFile():
+    # metrics.prom is only written with the Debug option, the diagnostics device is always updated
+    checks = []
+    for debug, expected in (("0", False), (str(plugin.METRICSFILE), True)):
+        with tempfile.TemporaryDirectory() as homeFolder:
+            wbPlugin, fake = benchmark.setup(1, 0, 0, homeFolder, debug=debug)
+            startPlugin(wbPlugin)
+            waitFor(lambda: not wbPlugin.messageQueue.unfinished)
+            wbPlugin.writeMetrics()
+            written = os.path.exists(os.path.join(homeFolder, "metrics.prom"))
+            plugin.onStop()
+            checks.append((f"metrics file {'written' if expected else 'not written'} with Debug {debug}", written == expected))
+    return checks
+
+def main():
+    DomoticzEx.reset()
+    plugin.Parameters = DomoticzEx.Parameters
+    plugin.Devices = DomoticzEx.Devices
+    checks = []
+    for scenario in (checkThrottledProbe, checkTokenRefresh, checkRunningSession, checkLostDatabase, checkThrottledRebuild, checkOcppCommand, checkFailedCommand, checkFailedSetpoint, checkDiscoveredUpdate, checkDepartedCharger, checkStop, checkMetricsFile):
+        checks.extend(scenario())
+    for name, passed in checks:
+        print(f"{'ok  ' if passed else 'FAIL'} {name}")
+    sys.exit(0 if all(passed for name, passed in checks) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Fake Wallbox cloud client for the harness
+#
+# Same methods as wallbox.Wallbox, answered from memory. Latency, errors and
+# the session history per charger can be configured.
+#
+import datetime
+import random
+import threading
+import time
+import requests
+
+class FakeCharger:
+    def __init__(self, chargerId):
+        self.chargerId = chargerId
+        self.statusId = 161             # Ready
+        self.locked = 0
+        self.chargingPower = 0.0
+        self.addedEnergy = 0.0
+        self.addedGreenEnergy = 0.0
+        self.maxChargingCurrent = 16
+        self.sessions = []              # Session dicts, newest first like the cloud
+
+    def status(self):
+        return {
+            "status_id": self.statusId,
+            "charging_power": self.chargingPower,
+            "charging_speed": 0,
+            "added_range": 0,
+            "added_energy": self.addedEnergy,
+            "added_green_energy": self.addedGreenEnergy,
+            "added_grid_energy": round(self.addedEnergy - self.addedGreenEnergy, 3),
+            "last_sync": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "current_mode": 0,
+            "finished": False,
+            "config_data": {
+                "locked": self.locked,
+                "max_charging_current": self.maxChargingCurrent,
+                "software": {
+                    "updateAvailable": False,
+                    "currentVersion": "6.4.10",
+                    "latestVersion": "6.4.10"
+                }
+            }
+        }
+
+class FakeWallbox:
+    def __init__(self, username="", password="", latency=0.0, errorRate=0.0, tokenLifetime=3600, seed=1, jwtTokenDrift=0):
+        self.username = username
+        self.password = password
+        self.latency = latency          # Seconds per call, or (min, max) tuple
+        self.errorRate = errorRate      # Fraction of calls failing with a 500 error
+        self.failures = []              # Status codes returned by the next calls, 0 raises a timeout,
+                                        # or method -> status codes returned by the next calls of that method
+        self.tokenLifetime = tokenLifetime
+        self.random = random.Random(seed)
+        self.chargers = {}
+        self.calls = {}                 # method -> count
+        self.lock = threading.Lock()
+        self.jwtToken = ""
+        self.jwtTokenTtl = 0
+        self.jwtTokenDrift = jwtTokenDrift
+
+    def addCharger(self, chargerId, sessions=0, days=365):
+        charger = FakeCharger(chargerId)
+        end = time.time()
+        start = end - days * 86400
+        starts = sorted((self.random.uniform(start, end) for _ in range(sessions)), reverse=True)
+        for index, sessionStart in enumerate(starts):
+            energy = round(self.random.uniform(1, 40), 3)
+            charger.sessions.append({
+                "type": "charger_log_session",
+                "id": f"{chargerId}-{len(starts) - index}",
+                "attributes": {
+                    "start": int(sessionStart),
+                    "end": int(sessionStart) + 3600,
+                    "energy": energy,
+                    "green_energy": round(energy * self.random.random(), 3)
+                }
+            })
+        self.chargers[chargerId] = charger
+        return charger
+
+    def call(self, method):
+        # Counted when the call completes, so callCount can be used to wait for a call
+        with self.lock:
+            failures = self.failures.get(method) if isinstance(self.failures, dict) else self.failures
+            failure = failures.pop(0) if failures else None
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self.random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if failure is None and self.errorRate and self.random.random() < self.errorRate:
+            failure = 500
+        if failure == 0:
+            raise requests.exceptions.Timeout(f"{method} timed out")
+        if failure is not None:
+            response = requests.Response()
+            response.status_code = failure
+            raise requests.exceptions.HTTPError(f"{failure} Error for {method}", response=response)
+        if method != "authenticate" and not self.jwtToken:
+            response = requests.Response()
+            response.status_code = 401
+            raise requests.exceptions.HTTPError(f"401 Client Error for {method}", response=response)
+
+    def callCount(self, method=None):
+        with self.lock:
+            if method is None:
+                return sum(self.calls.values())
+            return self.calls.get(method, 0)
+
+    def authenticate(self):
+        if self.jwtToken and self.jwtTokenTtl / 1000 - self.jwtTokenDrift > time.time():
+            return
+        self.call("authenticate")
+        self.jwtToken = f"token-{self.callCount('authenticate')}"
+        self.jwtTokenTtl = (time.time() + self.tokenLifetime) * 1000
+
+    def getChargersList(self):
+        self.call("getChargersList")
+        return list(self.chargers)
+
+    def getChargerStatus(self, chargerId):
+        self.call("getChargerStatus")
+        return self.chargers[int(chargerId)].status()
+
+    def lockCharger(self, chargerId):
+        self.call("lockCharger")
+        charger = self.chargers[int(chargerId)]
+        charger.locked = 1
+        charger.statusId = 209
+        return {"data": {"chargerData": {"locked": 1}}}
+
+    def unlockCharger(self, chargerId):
+        self.call("unlockCharger")
+        charger = self.chargers[int(chargerId)]
+        charger.locked = 0
+        charger.statusId = 161
+        return {"data": {"chargerData": {"locked": 0}}}
+
+    def resumeChargingSession(self, chargerId):
+        self.call("resumeChargingSession")
+        charger = self.chargers[int(chargerId)]
+        charger.statusId = 194
+        charger.chargingPower = 11.0
+        return {"result": "ok"}
+
+    def pauseChargingSession(self, chargerId):
+        self.call("pauseChargingSession")
+        charger = self.chargers[int(chargerId)]
+        charger.statusId = 182
+        charger.chargingPower = 0.0
+        return {"result": "ok"}
+
+    def setMaxChargingCurrent(self, chargerId, newMaxChargingCurrentValue):
+        self.call("setMaxChargingCurrent")
+        self.chargers[int(chargerId)].maxChargingCurrent = newMaxChargingCurrentValue
+        return {"data": {"chargerData": {"maxChargingCurrent": newMaxChargingCurrentValue}}}
+
+    def getSessionList(self, chargerId, startDate, endDate):
+        self.call("getSessionList")
+        start = startDate.timestamp()
+        end = endDate.timestamp()
+        sessions = self.chargers[int(chargerId)].sessions
+        return {"data": [session for session in sessions if start <= session["attributes"]["start"] <= end]}
@@ -0,0 +1,176 @@
+# Simulated OCPP 1.6-J charge point
+#
+# Connects to a central system, boots, and answers RemoteStart/RemoteStopTransaction,
+# ChangeAvailability and SetChargingProfile like a charger would, sending MeterValues while charging.
+#
+#   python harness/ocppchargepoint.py ws://localhost:9000/100000
+#   python harness/ocppchargepoint.py --selftest
+#
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+import websockets
+
+class SimulatedChargePoint:
+    def __init__(self, url, power=11000, meterInterval=1.0):
+        self.url = url
+        self.power = power                  # W while charging
+        self.meterInterval = meterInterval
+        self.register = 1000000             # Wh
+        self.transactionId = None
+        self.status = "Available"
+        self.limit = 32
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.websocket = None
+        self.meterTask = None
+
+    async def call(self, action, payload):
+        uniqueId = str(next(self.ids))
+        future = asyncio.get_running_loop().create_future()
+        self.pending[uniqueId] = future
+        await self.websocket.send(json.dumps([2, uniqueId, action, payload]))
+        result = await asyncio.wait_for(future, 10)
+        return result[2]
+
+    async def setStatus(self, status):
+        self.status = status
+        await self.call("StatusNotification", {"connectorId": 1, "errorCode": "NoError", "status": status})
+
+    async def meterValues(self):
+        while self.transactionId is not None:
+            await asyncio.sleep(self.meterInterval)
+            self.register += round(self.power * self.meterInterval / 3600)
+            await self.call("MeterValues", {
+                "connectorId": 1,
+                "transactionId": self.transactionId,
+                "meterValue": [{
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "sampledValue": [
+                        {"value": str(self.register), "measurand": "Energy.Active.Import.Register", "unit": "Wh"},
+                        {"value": str(self.power), "measurand": "Power.Active.Import", "unit": "W"},
+                        {"value": str(self.limit), "measurand": "Current.Offered", "unit": "A"}
+                    ]
+                }]
+            })
+
+    async def startTransaction(self):
+        result = await self.call("StartTransaction", {
+            "connectorId": 1, "idTag": "Domoticz", "meterStart": self.register,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
+        self.transactionId = result["transactionId"]
+        await self.setStatus("Charging")
+        self.meterTask = asyncio.create_task(self.meterValues())
+
+    async def stopTransaction(self):
+        transactionId, self.transactionId = self.transactionId, None
+        await self.call("StopTransaction", {
+            "transactionId": transactionId, "meterStop": self.register,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
+        await self.setStatus("Available")
+
+    async def handleCall(self, uniqueId, action, payload):
+        followUp = None
+        if action == "RemoteStartTransaction":
+            accepted = self.transactionId is None and self.status != "Unavailable"
+            followUp = self.startTransaction if accepted else None
+        elif action == "RemoteStopTransaction":
+            accepted = payload.get("transactionId") == self.transactionId
+            followUp = self.stopTransaction if accepted else None
+        elif action == "ChangeAvailability":
+            accepted = True
+            status = "Unavailable" if payload["type"] == "Inoperative" else "Available"
+            followUp = lambda: self.setStatus(status)
+        elif action == "SetChargingProfile":
+            accepted = True
+            self.limit = payload["csChargingProfiles"]["chargingSchedule"]["chargingSchedulePeriod"][0]["limit"]
+        else:
+            await self.websocket.send(json.dumps([4, uniqueId, "NotImplemented", action, {}]))
+            return
+        await self.websocket.send(json.dumps([3, uniqueId, {"status": "Accepted" if accepted else "Rejected"}]))
+        if followUp is not None:
+            asyncio.create_task(followUp())
+
+    async def receive(self):
+        async for raw in self.websocket:
+            message = json.loads(raw)
+            if message[0] == 2:
+                await self.handleCall(message[1], message[2], message[3])
+            else:
+                future = self.pending.pop(message[1], None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+
+    async def run(self, duration=None):
+        async with websockets.connect(self.url, subprotocols=["ocpp1.6"]) as websocket:
+            self.websocket = websocket
+            receiver = asyncio.create_task(self.receive())
+            await self.call("BootNotification", {"chargePointVendor": "Wall Box Chargers", "chargePointModel": "Simulated", "firmwareVersion": "6.4.10"})
+            await self.setStatus("Available")
+            if duration is None:
+                await receiver
+            else:
+                await asyncio.sleep(duration)
+                receiver.cancel()
+
+def selftest():
+    # Runs the plugin's OcppServer with the fake DomoticzEx module against this charge point
+    harnessFolder = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, harnessFolder)
+    sys.path.insert(1, os.path.dirname(harnessFolder))
+    import plugin
+
+    pushes = []
+    server = plugin.OcppServer(9987, lambda chargerId, status: pushes.append((chargerId, status)), host="127.0.0.1")
+    server.start()
+    chargePoint = SimulatedChargePoint("ws://127.0.0.1:9987/100000", meterInterval=0.2)
+
+    def waitFor(check, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if pushes and check(pushes[-1][1]):
+                return True
+            time.sleep(0.05)
+        return False
+
+    async def scenario():
+        task = asyncio.create_task(chargePoint.run())
+        loop = asyncio.get_running_loop()
+        checks = []
+        await loop.run_in_executor(None, waitFor, lambda status: status["status_id"] == 161)
+        checks.append(("boot and Available", server.isConnected("100000")))
+        await loop.run_in_executor(None, server.command, "100000", plugin.WallboxPlugin.DEVICESTARTSTOP, "On", 0)
+        checks.append(("RemoteStart -> Charging", await loop.run_in_executor(None, waitFor, lambda status: status["status_id"] == 194)))
+        checks.append(("MeterValues -> energy", await loop.run_in_executor(None, waitFor, lambda status: status["added_energy"] > 0 and status["charging_power"] == 11.0)))
+        await loop.run_in_executor(None, server.command, "100000", plugin.WallboxPlugin.DEVICESELECTHARGINGCURRENT, "Set Level", 16)
+        checks.append(("SetChargingProfile -> 16 A", await loop.run_in_executor(None, waitFor, lambda status: status["config_data"]["max_charging_current"] == 16)))
+        await loop.run_in_executor(None, server.command, "100000", plugin.WallboxPlugin.DEVICESTARTSTOP, "Off", 0)
+        checks.append(("RemoteStop -> Available", await loop.run_in_executor(None, waitFor, lambda status: status["status_id"] == 161 and status["finished"])))
+        await loop.run_in_executor(None, server.command, "100000", plugin.WallboxPlugin.DEVICELOCK, "On", 0)
+        checks.append(("ChangeAvailability -> Locked", await loop.run_in_executor(None, waitFor, lambda status: status["config_data"]["locked"] == 1)))
+        task.cancel()
+        return checks
+
+    checks = asyncio.run(scenario())
+    server.stop()
+    for name, passed in checks:
+        print(f"{'ok  ' if passed else 'FAIL'} {name}")
+    return all(passed for name, passed in checks)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated OCPP 1.6-J charge point")
+    parser.add_argument("url", nargs="?", help="Central system url, ending with the charge point id")
+    parser.add_argument("--selftest", action="store_true", help="Run against the plugin's OCPP server")
+    args = parser.parse_args()
+    if args.selftest:
+        sys.exit(0 if selftest() else 1)
+    if not args.url:
+        parser.error("url required")
+    asyncio.run(SimulatedChargePoint(args.url).run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Replays recorded Wallbox API traffic through the plugin
+#
+# Record with the Debug option "Record API traffic", then copy apitraffic.jsonl and run:
+#   python harness/replay.py apitraffic.jsonl --speed 60
+#
+# The recorded polls, commands and backfills are fed to the plugin worker at their recorded
+# times divided by speed (0 = as fast as possible). ReplayWallbox answers every call with the
+# recorded response of the same method and charger, in recorded order.
+#
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import requests
+
+harnessFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, harnessFolder)
+sys.path.insert(1, os.path.dirname(harnessFolder))
+
+import DomoticzEx
+import benchmark
+import plugin
+
+def loadRecording(path):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                print(f"{path}:{number}: skipped, not valid JSON")
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+def callKey(method, args):
+    # Session lists are matched on the charger only, their dates differ per run
+    return (method, str(args[0]) if args else "")
+
+class ReplayWallbox:
+    def __init__(self, entries, latency=True, speed=1.0):
+        self.latency = latency          # Sleep the recorded duration (divided by speed)
+        self.speed = speed
+        self.responses = {}             # (method, charger) -> [entries]
+        self.position = {}
+        self.calls = 0
+        self.missing = 0
+        self.lock = threading.Lock()
+        self.jwtToken = ""
+        self.jwtTokenTtl = 0
+        self.jwtTokenDrift = 0
+        for entry in entries:
+            self.responses.setdefault(callKey(entry["m"], entry["a"]), []).append(entry)
+
+    def authenticate(self):
+        self.jwtToken = "replay"
+        self.jwtTokenTtl = (time.time() + 3600) * 1000
+
+    def getChargersList(self):
+        if ("getChargersList", "") in self.responses:
+            return self.answer("getChargersList", ())
+        return sorted({int(key[1]) for key in self.responses if key[0] == "getChargerStatus"})
+
+    def answer(self, method, args):
+        key = callKey(method, args)
+        with self.lock:
+            self.calls += 1
+            recorded = self.responses.get(key)
+            if not recorded:
+                self.missing += 1
+                raise KeyError(f"No recorded response for {method} {key[1]}")
+            # Repeat the last response once the recording of this call is used up
+            index = self.position.get(key, 0)
+            self.position[key] = index + 1
+            entry = recorded[min(index, len(recorded) - 1)]
+        if self.latency and self.speed:
+            time.sleep(entry["d"] / self.speed)
+        if "e" in entry:
+            error = entry["e"]
+            if "status" in error:
+                response = requests.Response()
+                response.status_code = error["status"]
+                raise requests.exceptions.HTTPError(error["message"], response=response)
+            raise getattr(requests.exceptions, error["type"], RuntimeError)(error["message"])
+        return entry["r"]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.answer(name, args)
+
+commandUnits = {
+    "lockCharger": (plugin.WallboxPlugin.DEVICELOCK, "On"),
+    "unlockCharger": (plugin.WallboxPlugin.DEVICELOCK, "Off"),
+    "resumeChargingSession": (plugin.WallboxPlugin.DEVICERESUME, "On"),
+    "pauseChargingSession": (plugin.WallboxPlugin.DEVICEPAUSE, "On"),
+    "setMaxChargingCurrent": (plugin.WallboxPlugin.DEVICESELECTHARGINGCURRENT, "Set Level")
+}
+
+def replay(entries, speed, latency, homeFolder):
+    wbPlugin, fake = benchmark.setup(0, 0, 0, homeFolder, budget=1000000)
+    client = ReplayWallbox(entries, latency=latency, speed=speed)
+    plugin.Wallbox = lambda username, password, **kwargs: client
+    plugin.onStart()
+    deadline = time.time() + 60
+    while time.time() < deadline and not any("Entering message handler" in text for level, text in DomoticzEx.messages):
+        time.sleep(0.01)
+
+    events = 0
+    start = time.time()
+    first = entries[0]["t"] if entries else 0
+    for entry in entries:
+        if speed:
+            delay = (entry["t"] - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        method = entry["m"]
+        chargerId = str(entry["a"][0]) if entry["a"] else None
+        if method == "getChargerStatus":
+            wbPlugin.messageQueue.put({"Type":"Update", "DeviceID": chargerId})
+        elif method == "getSessionList":
+            wbPlugin.messageQueue.put({"Type":"Backfill", "DeviceID": chargerId})
+        elif method in commandUnits:
+            unit, command = commandUnits[method]
+            level = entry["a"][1] if len(entry["a"]) > 1 else 0
+            plugin.onCommand(chargerId, unit, command, level, None)
+        else:
+            continue
+        events += 1
+    # Wait for delayed messages too, e.g. debounced setpoints and command verifications
+    while wbPlugin.messageQueue.delayed or wbPlugin.messageQueue.qsize():
+        time.sleep(0.05)
+    wbPlugin.messageQueue.join()
+    elapsed = time.time() - start
+    stats = wbPlugin.messageQueue.stats()
+    tasks = {key[1]: (histogram[-2], histogram[-1]) for key, histogram in wbPlugin.metrics.histograms.items() if key[0] == "task"}
+    plugin.onStop()
+    return events, elapsed, stats, tasks, client
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Wallbox API traffic through the plugin")
+    parser.add_argument("recording", help="apitraffic.jsonl written by the plugin")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time acceleration, 0 replays as fast as possible")
+    parser.add_argument("--no-latency", action="store_true", help="Answer calls right away instead of with the recorded duration")
+    args = parser.parse_args()
+
+    entries = loadRecording(args.recording)
+    span = entries[-1]["t"] - entries[0]["t"] if entries else 0
+    print(f"Recording: {len(entries)} calls over {span / 3600:.1f} h, speed {args.speed or 'max'}")
+    with tempfile.TemporaryDirectory() as homeFolder:
+        events, elapsed, stats, tasks, client = replay(entries, args.speed, not args.no_latency, homeFolder)
+    print(f"Replayed {events} events in {elapsed:.2f} s, {client.calls} client calls, {client.missing} without recorded response")
+    for messageType, (count, seconds) in sorted(tasks.items()):
+        print(f"{messageType:10} {count:7} tasks  mean {seconds / count * 1000:9.2f} ms")
+    print(f"{'Update calls':18} {DomoticzEx.count('Update')}")
+    print(f"Message queue {stats}")
+    errors = [text for level, text in DomoticzEx.messages if level == "Error"]
+    print(f"Errors logged: {len(errors)}")
+    for text in errors[:10]:
+        print(f"  {text}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# Unit checks for the plugin classes that need no running plugin
+#
+# Uses the fake DomoticzEx module and the fake Wallbox client, run with:
+#   python -m pytest -q harness
+#
+import datetime
+import os
+import sys
+import time
+
+import pytest
+import requests
+
+harnessFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, harnessFolder)
+sys.path.insert(1, os.path.dirname(harnessFolder))
+
+from fakewallbox import FakeWallbox
+import plugin
+
+def httpError(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} Error", response=response)
+
+def session(sessionId, start, energy):
+    return {"type": "charger_log_session", "id": sessionId,
+            "attributes": {"start": start, "end": start + 3600, "energy": energy, "green_energy": energy / 2}}
+
+def day(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+def test_queue_priorities():
+    queue = plugin.MessageQueue()
+    queue.put({"Type": "Backfill", "DeviceID": "1"})
+    queue.put({"Type": "Update", "DeviceID": "1"})
+    queue.put({"Type": "Command", "DeviceID": "1"})
+    queue.put({"Type": "Update", "DeviceID": "2"})
+    order = [queue.get(block=False) for _ in range(4)]
+    assert [(message["Type"], message["DeviceID"]) for message in order] == [
+        ("Command", "1"), ("Update", "1"), ("Update", "2"), ("Backfill", "1")]
+
+def test_queue_coalesces_updates():
+    queue = plugin.MessageQueue()
+    queue.put({"Type": "Update", "DeviceID": "1"})
+    queue.put({"Type": "Update", "DeviceID": "1"})
+    assert queue.qsize() == 1 and queue.coalesced == 1
+    queue.get(block=False)
+    queue.put({"Type": "Update", "DeviceID": "1"})
+    assert queue.qsize() == 1 and queue.coalesced == 1
+
+def test_queue_put_later():
+    queue = plugin.MessageQueue()
+    queue.putLater({"Type": "Backfill", "DeviceID": "1"}, 60)
+    queue.putLater({"Type": "Discover"}, 0)
+    assert queue.get(block=False)["Type"] == "Discover"
+    with pytest.raises(IndexError):
+        queue.get(block=False)
+    assert len(queue.delayed) == 1
+    assert queue.close() == 1
+    assert queue.get(block=False) is None
+
+def test_poll_idle_backoff():
+    scheduler = plugin.PollScheduler("READY:100")
+    scheduler.add(1)
+    intervals = []
+    for _ in range(12):
+        scheduler.observe(1, "READY")
+        intervals.append(scheduler.chargers["1"]["interval"])
+    assert intervals[:3] == [100, 150, 225]
+    assert intervals[-1] == scheduler.maxIdleInterval
+    scheduler.observe(1, "CHARGING")
+    assert scheduler.chargers["1"]["interval"] == 10
+
+def test_poll_budget_scale():
+    scheduler = plugin.PollScheduler(pollRate=0.1)
+    for chargerId in range(10):
+        scheduler.add(chargerId)
+    now = 1000000
+    assert len(scheduler.due(now)) == 10
+    assert scheduler.scale == pytest.approx(10 / 30 / 0.1)
+    assert scheduler.chargers["0"]["nextPoll"] == pytest.approx(now + 100)
+    scheduler.remove(0)
+    assert "0" not in scheduler.due(now + 100)
+    assert scheduler.scale == pytest.approx(9 / 30 / 0.1)
+
+def test_poll_command_boost():
+    scheduler = plugin.PollScheduler()
+    scheduler.add(1)
+    scheduler.observe(1, "LOCKED")
+    scheduler.commandSent(1)
+    charger = scheduler.chargers["1"]
+    assert charger["nextPoll"] - charger["boostUntil"] <= scheduler.commandInterval - scheduler.commandBoostTime
+    assert scheduler.currentInterval(charger, charger["boostUntil"] - 1) == scheduler.commandInterval
+
+def test_cron_next():
+    schedule = plugin.CronSchedule("30 4 * * 1-5")
+    friday = datetime.datetime(2024, 5, 3, 4, 30)
+    assert schedule.next(friday) == datetime.datetime(2024, 5, 6, 4, 30)
+    assert schedule.next(friday - datetime.timedelta(minutes=1)) == friday
+    assert plugin.CronSchedule("0 0 31 * *").next(datetime.datetime(2024, 2, 1)) == datetime.datetime(2024, 3, 31)
+    with pytest.raises(ValueError):
+        plugin.CronSchedule("60 * * * *")
+
+def test_jobs_catch_up_once():
+    jobs = plugin.JobScheduler()
+    runs = []
+    jobs.add("backfill", "30 4 * * *", lambda: runs.append("backfill"))
+    jobs.add("metrics", 60, lambda: runs.append("metrics"))
+    first = jobs.nextRun("backfill")
+    jobs.runDue(first - 1)
+    assert "backfill" not in runs
+    runs.clear()
+    # Three days of missed runs are caught up with one run, the next one is after the late time
+    late = first + 3 * 86400 + 10
+    jobs.runDue(late)
+    assert runs.count("backfill") == 1 and runs.count("metrics") == 1
+    assert late < jobs.nextRun("backfill") <= late + 86400
+    assert jobs.nextRun("metrics") == late + 60
+
+def test_breaker_transitions():
+    breaker = plugin.CircuitBreaker()
+    for _ in range(breaker.failureThreshold - 1):
+        breaker.failure(httpError(500))
+    assert breaker.state == breaker.CLOSED
+    breaker.failure(httpError(500))
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(plugin.CircuitOpenError):
+        breaker.check()
+    breaker.retryAt = 0
+    breaker.check()
+    assert breaker.state == breaker.HALFOPEN
+    breaker.skipped()
+    assert breaker.state == breaker.OPEN
+    breaker.retryAt = 0
+    breaker.check()
+    breaker.failure(requests.exceptions.Timeout())
+    assert breaker.state == breaker.OPEN and breaker.openCount == 2
+    breaker.retryAt = 0
+    breaker.check()
+    breaker.success()
+    assert breaker.state == breaker.CLOSED and breaker.failures == 0 and breaker.openCount == 0
+
+def test_breaker_opens_on_auth():
+    breaker = plugin.CircuitBreaker()
+    breaker.failure(ValueError("not a cloud failure"))
+    assert breaker.state == breaker.CLOSED
+    breaker.failure(httpError(401))
+    assert breaker.state == breaker.OPEN and breaker.lastFailure == "auth"
+
+def test_budget_backfill_uses_spare_tokens():
+    budget = plugin.ApiBudget()
+    for _ in range(budget.burst - budget.reserves["backfill"]):
+        budget.acquire("getSessionList")
+    with pytest.raises(plugin.ThrottledError):
+        budget.acquire("getSessionList")
+    budget.acquire("getChargerStatus")
+    assert budget.used == {"backfill": 5, "poll": 1} and budget.throttled == {"backfill": 1}
+
+def test_database_upsert():
+    database = plugin.SessionDatabase(":memory:")
+    start = int(datetime.datetime(2024, 5, 3, 12).timestamp())
+    assert database.insert(1, [session("a", start, 10.0)]) == 1
+    assert database.insert(1, [session("a", start, 10.0)]) == 0
+    assert database.insert(1, [session("a", start, 12.5), session("b", start + 60, 1.0)]) == 2
+    assert database.dailyTotals(1) == {day(start): [13500, 6750]}
+    assert database.lastStart(1) == start + 60
+    assert database.dailyTotals(2) == {}
+
+def test_database_daily_totals_since():
+    database = plugin.SessionDatabase(":memory:")
+    first = int(datetime.datetime(2024, 5, 3, 12).timestamp())
+    second = int(datetime.datetime(2024, 5, 4, 12).timestamp())
+    database.insert(1, [session("a", first, 1.0), session("b", second, 2.0)])
+    assert database.dailyTotals(1, second) == {day(second): [2000, 1000]}
+    assert database.totals(1, first, second) == (1, 1000, 500)
+
+class ThrottledWallbox(FakeWallbox):
+    # Allows `allowed` session list calls, then raises ThrottledError
+    allowed = 0
+
+    def getSessionList(self, chargerId, startDate, endDate):
+        if not self.allowed:
+            raise plugin.ThrottledError("getSessionList refused, API budget used up")
+        self.allowed -= 1
+        return super().getSessionList(chargerId, startDate, endDate)
+
+def test_throttled_download_resumes(tmp_path):
+    # Every retry after a throttled window continues after the last stored window,
+    # month windows are used as the database has a session already
+    fake = ThrottledWallbox()
+    fake.authenticate()
+    fake.addCharger(1, sessions=50, days=200)
+    wbPlugin = plugin.WallboxPlugin()
+    wbPlugin.wallbox = fake
+    store = plugin.SessionStore(str(tmp_path), 1)
+    database = plugin.SessionDatabase(":memory:")
+    database.insert(1, [session("old", int(time.time()) - 250 * 86400, 1.0)])
+    syncedUntil = []
+    for attempt in range(40):
+        fake.allowed = 1
+        try:
+            wbPlugin.downloadSessions(1, store, database)
+            break
+        except plugin.ThrottledError:
+            syncedUntil.append(store["syncedUntil"])
+    else:
+        pytest.fail("download does not complete")
+    assert syncedUntil == sorted(set(syncedUntil))
+    assert len(syncedUntil) >= 8
+    assert database.totals(1)[0] == 51
@@ -23,17 +23,32 @@
             <li>Session Energy - Total Energy charged during the last session. </li>
             <li>Total Energy - Total Energy charged. </li>
             <li>Total Green Energy - Total Green Energy charged. </li>
+            <li>Session Green Energy - Green Energy charged during the last session, with daily history. </li>
             <li>Firmware - Information about the installed firmware. </li>
             <li>MaxCharging - Current Max Charging (A)</li>
             <li>SetMaxCharging - Set Charging for Inverter (6A-32A). </li>
         </ul>
+        A Diagnostics device with API latency, API errors and queue depth is created as unused device, enable it in Devices when needed.
+        Debug option Write metrics file writes the metrics to metrics.prom in the plugin folder every minute in Prometheus text format.
+        Debug option Record API traffic appends every Wallbox call with its response to apitraffic.jsonl in the plugin folder, without credentials.
+        Debug option Profile worker profiles a sample of the worker tasks and tracks memory allocations. Every hour, or when the
+        Write profile button of the Diagnostics device is pushed, hotspots and allocation growth are written to profile_*.txt in the plugin folder.
         <h3>Configuration</h3>
         Fill in your Wallbox email and password.
         Select Day Hour and Minute to auto update your Historic Sessions periodicly. 
+        Poll intervals sets the seconds between status updates per charger state, e.g. CHARGING:10,READY:120.
+        Idle chargers back off gradually, after a command the charger is polled every 10 seconds for a minute.
+        BUDGET:60 in the poll intervals limits the Wallbox requests per minute of the plugin, poll intervals are stretched when needed.
+        Fill in an OCPP port to run a local OCPP 1.6-J central system. Configure ws://&lt;domoticz ip&gt;:&lt;port&gt;/&lt;charger id&gt;
+        as OCPP server in the Wallbox app, the charger then pushes its status instead of being polled in the cloud.
+        OCPP address is the address the central system listens on, empty for all addresses. Only chargers of your
+        Wallbox account, or that already have devices in Domoticz, are accepted. This needs the websockets package.
     </description>
     <params>
         <param field="Username" label="Username:" width="200px" required="true" default="name@gmail.com"/>
         <param field="Password" label="Password" width="200px" required="true" default="" password="true"/>
+        <param field="Address" label="OCPP address" width="150px" default="127.0.0.1"/>
+        <param field="Port" label="OCPP port" width="75px" default=""/>
         <param field="Mode1" label="Day" width="75px">
             <options>
                 <option label="Monday" value="0"/>
@@ -47,6 +62,13 @@
         </param>
         <param field="Mode2" label="Hour" width="75px" required="true" default="03"/>
         <param field="Mode3" label="Minute" width="75px" required="true" default="00"/>
+        <param field="Mode4" label="History" width="150px">
+            <options>
+                <option label="Incremental" value="0" default="true" />
+                <option label="Full rebuild on start" value="1"/>
+            </options>
+        </param>
+        <param field="Mode5" label="Poll intervals (s)" width="400px" default="CHARGING:10,WAITING:30,PAUSED:30,READY:120,LOCKED:300,DISCONNECTED:300"/>
         <param field="Mode6" label="Debug" width="150px">
             <options>
                 <option label="None" value="0"  default="true" />
@@ -56,6 +78,10 @@
                 <option label="Queue" value="128"/>
                 <option label="Connections Only" value="16"/>
                 <option label="Connections+Queue" value="144"/>
+                <option label="Record API traffic" value="1024"/>
+                <option label="Python+Record API traffic" value="1026"/>
+                <option label="Profile worker" value="2048"/>
+                <option label="Write metrics file" value="4096"/>
                 <option label="All" value="-1"/>
             </options>
         </param>
@@ -66,18 +92,1598 @@ import DomoticzEx as Domoticz
 from wallbox import Wallbox, Statuses
 import time
 import datetime
-import queue
+import heapq
 import threading
+import weakref
+import concurrent.futures
 import json
-
-def dumpJson(name, msg):
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Domoticz debug mask as configured in Mode6, Domoticz.Debug only shows output for the Python flag
+debugLevel = 0
+DEBUGPYTHON = 2
+RECORDAPI = 1024               # Not a Domoticz debug flag, selects the API traffic recorder
+PROFILE = 2048                 # Not a Domoticz debug flag, selects the worker profiler
+METRICSFILE = 4096             # Not a Domoticz debug flag, selects the metrics.prom file
+dumpMaxLength = 4096           # Max characters of a json dump written to the log, None for no limit
+
+def setDebugLevel(level):
+    global debugLevel
+    debugLevel = level
+
+def debugEnabled():
+    return debugLevel == -1 or bool(debugLevel & DEBUGPYTHON)
+
+def recordingEnabled():
+    return debugLevel != -1 and bool(debugLevel & RECORDAPI)
+
+def profilingEnabled():
+    return debugLevel != -1 and bool(debugLevel & PROFILE)
+
+def metricsFileEnabled():
+    return debugLevel != -1 and bool(debugLevel & METRICSFILE)
+
+def logDebug(message, *args):
+    # Formats the message only when it will be logged
+    if debugEnabled():
+        Domoticz.Debug(message % args if args else message)
+
+def dumpJson(name, msg, maxLength=None):
+    if not debugEnabled():
+        return
     messageJson = json.dumps(msg,
                 skipkeys = True,
                 allow_nan = True,
                 indent = 6)
+    if maxLength is None:
+        maxLength = dumpMaxLength
+    if maxLength is not None and len(messageJson) > maxLength:
+        messageJson = f"{messageJson[:maxLength]}... ({len(messageJson)} characters)"
     Domoticz.Debug('Message: '+name )
     Domoticz.Debug(messageJson)
 
+class SessionStore:
+    # Persistent per charger checkpoint of the processed session history.
+    # Holds the start timestamp of the last synced session, the running totals
+    # and the day that is still open (not written to the Domoticz history yet).
+    # syncedUntil is the end of the last session list window stored in the session database,
+    # a next sync downloads from there and recomputes the days from the overlap on.
+    version = 2
+    defaults = {
+        "version": version,
+        "lastStart": 0,
+        "syncedUntil": 0,
+        "sessionCount": 0,
+        "totalEnergy": 0,
+        "totalGreenEnergy": 0,
+        "currentDate": "",
+        "dayEnergy": 0,
+        "dayGreenEnergy": 0
+    }
+
+    def __init__(self, folder, chargerId):
+        self.path = os.path.join(folder, f"sessions_{chargerId}.json")
+        self.data = dict(self.defaults)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored.get("version") != self.version:
+                Domoticz.Log(f"Session store {self.path} has an old format, rebuilding")
+                return
+            for key in self.defaults:
+                if key in stored:
+                    self.data[key] = stored[key]
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as err:
+            Domoticz.Error(f"Session store {self.path} unreadable, rebuilding: {err}")
+            self.reset()
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmpPath, self.path)
+
+    def reset(self):
+        self.data = dict(self.defaults)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+class Snapshot:
+    # Last known state of the plugin for a warm start: the charger list, per charger
+    # totals and status, and the Wallbox token. Readable by the Domoticz user only.
+    version = 1
+    defaults = {
+        "version": version,
+        "username": "",
+        "chargers": [],
+        "token": "",
+        "tokenTtl": 0,
+        "states": {}
+    }
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, "snapshot.json")
+        self.data = dict(self.defaults)
+
+    def load(self):
+        # Returns True when a usable snapshot was read
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored.get("version") != self.version:
+                return False
+            self.data.update((key, stored[key]) for key in self.defaults if key in stored)
+            return len(self.data["chargers"]) > 0
+        except FileNotFoundError:
+            return False
+        except (ValueError, OSError) as err:
+            Domoticz.Error(f"Snapshot {self.path} unreadable, starting cold: {err}")
+            return False
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmpPath, self.path)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+class SessionDatabase:
+    # Local SQLite copy of the charger_log_session records of all chargers.
+    # Energy is stored in Wh, sessions are indexed on (charger, start) so day and
+    # month aggregates are answered locally instead of downloading the history again.
+    schema = (
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " id TEXT PRIMARY KEY,"
+        " charger TEXT NOT NULL,"
+        " start INTEGER NOT NULL,"
+        " end INTEGER,"
+        " energy INTEGER NOT NULL,"
+        " green_energy INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sessions_charger_start ON sessions (charger, start)"
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            for statement in self.schema:
+                self.connection.execute(statement)
+
+    def insert(self, chargerId, sessions):
+        # Adds or updates the charger_log_session records of a getSessionList response,
+        # returns the number of new or changed sessions
+        rows = [(
+            str(session["id"]),
+            str(chargerId),
+            int(session["attributes"]["start"]),
+            session["attributes"].get("end"),
+            int(session["attributes"]["energy"] * 1000),
+            int(session["attributes"]["green_energy"] * 1000)
+        ) for session in sessions if session["type"] == "charger_log_session"]
+        with self.lock, self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET"
+                " start = excluded.start, end = excluded.end, energy = excluded.energy, green_energy = excluded.green_energy"
+                " WHERE start != excluded.start OR end IS NOT excluded.end OR energy != excluded.energy OR green_energy != excluded.green_energy",
+                rows)
+            return self.connection.total_changes - before
+
+    def lastStart(self, chargerId):
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(start) FROM sessions WHERE charger = ?", (str(chargerId),)).fetchone()
+        return row[0] or 0
+
+    def dailyTotals(self, chargerId, start=0):
+        # Returns {day: [energy Wh, green energy Wh]} of the sessions started at or after start
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT date(start, 'unixepoch', 'localtime') AS day, SUM(energy), SUM(green_energy)"
+                " FROM sessions WHERE charger = ? AND start >= ? GROUP BY day",
+                (str(chargerId), start)).fetchall()
+        return {day: [energy, greenEnergy] for day, energy, greenEnergy in rows}
+
+    def totals(self, chargerId, start=0, end=None):
+        # Number of sessions, energy and green energy (Wh) of the sessions started in [start, end)
+        if end is None:
+            end = 2 ** 62
+        with self.lock:
+            count, energy, greenEnergy = self.connection.execute(
+                "SELECT COUNT(*), TOTAL(energy), TOTAL(green_energy) FROM sessions WHERE charger = ? AND start >= ? AND start < ?",
+                (str(chargerId), start, end)).fetchone()
+        return count, int(energy), int(greenEnergy)
+
+    def monthTotals(self, chargerId, months=12):
+        # [(month, sessions, energy Wh, green energy Wh)] of the last months, oldest first
+        with self.lock:
+            return self.connection.execute(
+                "SELECT strftime('%Y-%m', start, 'unixepoch', 'localtime') AS month, COUNT(*), SUM(energy), SUM(green_energy)"
+                " FROM sessions WHERE charger = ? AND start >= strftime('%s', 'now', 'start of month', ?, 'utc')"
+                " GROUP BY month ORDER BY month",
+                (str(chargerId), f"-{months - 1} months")).fetchall()
+
+    def clear(self, chargerId):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM sessions WHERE charger = ?", (str(chargerId),))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class Metrics:
+    # Latency histograms and error counters, written as a Prometheus text file.
+    # Histograms are keyed by (metric, label value), e.g. ("api", "getChargerStatus").
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    metricInfo = {
+        "api": ("wallbox_api_request_seconds", "method", "Latency of Wallbox cloud API calls"),
+        "task": ("wallbox_task_seconds", "type", "Time spent on worker thread messages"),
+        "device": ("wallbox_unit_update_seconds", "unit", "Time spent on Domoticz unit updates")
+    }
+
+    def __init__(self):
+        self.histograms = {}    # (metric, label) -> [bucket counts..., count, sum]
+        self.errors = {}        # (metric, label) -> count
+        self.lock = threading.Lock()
+
+    def observe(self, metric, label, seconds, error=False):
+        with self.lock:
+            histogram = self.histograms.get((metric, label))
+            if histogram is None:
+                histogram = self.histograms[(metric, label)] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            if error:
+                self.errors[(metric, label)] = self.errors.get((metric, label), 0) + 1
+
+    def totals(self, metric):
+        # Returns count, total seconds and errors of all labels of a metric
+        with self.lock:
+            count = sum(histogram[-2] for key, histogram in self.histograms.items() if key[0] == metric)
+            seconds = sum(histogram[-1] for key, histogram in self.histograms.items() if key[0] == metric)
+            errors = sum(value for key, value in self.errors.items() if key[0] == metric)
+        return count, seconds, errors
+
+    def prometheus(self, gauges=()):
+        # gauges: (name, type, help, value) for values owned by other objects
+        lines = []
+        with self.lock:
+            for metric, (name, labelName, helpText) in self.metricInfo.items():
+                keys = sorted(key for key in self.histograms if key[0] == metric)
+                if not keys:
+                    continue
+                lines.append(f"# HELP {name} {helpText}")
+                lines.append(f"# TYPE {name} histogram")
+                for key in keys:
+                    histogram = self.histograms[key]
+                    label = f'{labelName}="{key[1]}"'
+                    for index, bound in enumerate(self.buckets):
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {histogram[index]}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram[-2]}')
+                    lines.append(f"{name}_sum{{{label}}} {histogram[-1]:.6f}")
+                    lines.append(f"{name}_count{{{label}}} {histogram[-2]}")
+                errorName = name.replace("_seconds", "_errors_total")
+                lines.append(f"# TYPE {errorName} counter")
+                for key in keys:
+                    lines.append(f'{errorName}{{{labelName}="{key[1]}"}} {self.errors.get(key, 0)}')
+        for name, metricType, helpText, value in gauges:
+            lines.append(f"# HELP {name} {helpText}")
+            lines.append(f"# TYPE {name} {metricType}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, gauges=()):
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as f:
+            f.write(self.prometheus(gauges))
+        os.replace(tmpPath, path)
+
+class CircuitOpenError(Exception):
+    pass
+
+class ThrottledError(Exception):
+    pass
+
+class ApiBudget:
+    # Token bucket shared by every call to the Wallbox cloud. Commands may borrow tokens
+    # that are paid back by delaying polls, logins may use the whole bucket, polls leave a
+    # reserve for commands and backfills only use spare tokens.
+    defaultRate = 60            # Requests per minute
+    burst = 10
+    reserves = {                # kind -> tokens that must stay in the bucket
+        "command": -5,
+        "auth": 0,
+        "poll": 2,
+        "backfill": 5
+    }
+    maxWaits = {                # kind -> seconds a call may wait for a token, polls and backfills
+        "command": 30,          # run on wbThread and must not hold up commands
+        "auth": 30,
+        "poll": 2,
+        "backfill": 0
+    }
+    kinds = {
+        "authenticate": "auth",
+        "getChargerStatus": "poll",
+        "getChargersList": "backfill",
+        "getSessionList": "backfill"
+    }
+    pollShare = 0.7             # Part of the rate planned for status polls
+
+    def __init__(self, rate=defaultRate):
+        self.rate = max(1, rate) / 60
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.used = {}          # kind -> requests
+        self.throttled = {}     # kind -> requests that had to wait or were refused
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def kind(self, method):
+        return self.kinds.get(method, "command")
+
+    def refill(self):
+        # Caller holds the condition
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, method):
+        kind = self.kind(method)
+        reserve = self.reserves[kind]
+        deadline = time.monotonic() + self.maxWaits[kind]
+        with self.condition:
+            waited = False
+            while True:
+                if self.cancelled:
+                    raise requests.exceptions.ConnectionError(f"Plugin is stopping, {method} not called")
+                self.refill()
+                if self.tokens - 1 >= reserve:
+                    self.tokens -= 1
+                    self.used[kind] = self.used.get(kind, 0) + 1
+                    return
+                if not waited:
+                    waited = True
+                    self.throttled[kind] = self.throttled.get(kind, 0) + 1
+                wait = (reserve + 1 - self.tokens) / self.rate
+                if time.monotonic() + wait > deadline:
+                    raise ThrottledError(f"{method} refused, API budget used up")
+                self.condition.wait(wait)
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def pollRate(self):
+        # Polls per second the poll scheduler may plan for all chargers together
+        return self.rate * self.pollShare
+
+    def level(self):
+        with self.condition:
+            self.refill()
+            return self.tokens
+
+    def stats(self):
+        with self.condition:
+            used = " ".join(f"{kind}: {count}" for kind, count in sorted(self.used.items()))
+            throttled = " ".join(f"{kind}: {count}" for kind, count in sorted(self.throttled.items()))
+            return f"{self.rate * 60:.0f}/min tokens: {self.tokens:.1f} used {used} throttled {throttled}"
+
+class CircuitBreaker:
+    # Stops calling the Wallbox cloud after repeated failures.
+    # Open: calls fail immediately with CircuitOpenError until retryAt.
+    # Half open: one probe call is let through, success closes the circuit, failure opens it again
+    # with a doubled delay. Authentication failures and rate limiting open the circuit directly.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALFOPEN = "half open"
+    failureThreshold = 3        # Consecutive server or timeout failures before opening
+    baseDelays = {
+        "auth": 300,
+        "ratelimit": 60,
+        "server": 30,
+        "timeout": 30
+    }
+    maxDelay = 1800
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openCount = 0
+        self.retryAt = 0
+        self.lastFailure = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def classify(err):
+        # Returns the failure kind, or None for errors that do not indicate an unavailable cloud
+        if isinstance(err, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return "timeout"
+        if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+            status = err.response.status_code
+            if status in (401, 403):
+                return "auth"
+            if status == 429:
+                return "ratelimit"
+            if status >= 500:
+                return "server"
+        return None
+
+    def check(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() >= self.retryAt:
+                self.state = self.HALFOPEN
+                Domoticz.Log("Wallbox circuit half open, probing the cloud")
+                return
+            raise CircuitOpenError(f"Wallbox cloud unavailable ({self.lastFailure}), retry after {datetime.datetime.fromtimestamp(self.retryAt).strftime('%H:%M:%S')}")
+
+    def skipped(self):
+        # The call was not sent, a half open circuit waits for the next probe
+        with self.lock:
+            if self.state == self.HALFOPEN:
+                self.state = self.OPEN
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                Domoticz.Log("Wallbox circuit closed, cloud available again")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.openCount = 0
+
+    def failure(self, err):
+        kind = self.classify(err)
+        if kind is None:
+            self.success()
+            return
+        with self.lock:
+            self.failures += 1
+            self.lastFailure = kind
+            if self.state == self.OPEN:
+                return
+            if self.state == self.CLOSED and kind in ("server", "timeout") and self.failures < self.failureThreshold:
+                return
+            self.openCount += 1
+            delay = min(self.maxDelay, self.baseDelays[kind] * 2 ** (self.openCount - 1))
+            delay = random.uniform(delay / 2, delay)
+            if kind == "ratelimit":
+                try:
+                    delay = max(delay, float(err.response.headers.get("Retry-After", 0)))
+                except ValueError:
+                    pass
+            self.state = self.OPEN
+            self.retryAt = time.time() + delay
+            Domoticz.Error(f"Wallbox circuit open after {kind} failure: {err}. Retry in {round(delay)} seconds")
+
+    def isOpen(self):
+        return self.state != self.CLOSED
+
+class HttpTransport:
+    # Takes the place of the requests module inside the wallbox library, so its get/put/post
+    # calls share one keep-alive session with a timeout per Wallbox operation.
+    # Everything else (exceptions, Response, ...) is taken from the requests module.
+    timeouts = {                # operation -> (connect, read) seconds
+        "authenticate": (5, 15),
+        "getChargersList": (5, 15),
+        "getChargerStatus": (5, 10),
+        "getSessionList": (5, 60)
+    }
+    defaultTimeout = (5, 20)
+
+    def __init__(self, poolSize=8):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        # Every connection is tracked, so abort can also close the ones in use
+        self.opened = weakref.WeakSet()
+        self.adapter.poolmanager.pool_classes_by_scheme = {
+            "http": self.tracked(HTTPConnectionPool),
+            "https": self.tracked(HTTPSConnectionPool)
+        }
+        self.local = threading.local()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def tracked(self, poolClass):
+        opened = self.opened
+        class TrackedPool(poolClass):
+            def _new_conn(self):
+                connection = super()._new_conn()
+                opened.add(connection)
+                return connection
+        return TrackedPool
+
+    def install(self, client):
+        # Returns False when the module of the client does not use the requests module
+        module = sys.modules.get(type(client).__module__)
+        if getattr(module, "requests", None) is not requests:
+            return False
+        module.requests = self
+        return True
+
+    def operation(self, name):
+        # Wallbox method run by this thread, selects the timeout of its requests
+        self.local.operation = name
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeouts.get(getattr(self.local, "operation", None), self.defaultTimeout)
+        with self.lock:
+            self.requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def connections(self):
+        # Connections (TLS handshakes) opened so far by the pools of the session
+        pools = self.adapter.poolmanager.pools
+        count = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                count += pool.num_connections
+        return count
+
+    def stats(self):
+        connections = self.connections()
+        reused = 1 - connections / self.requests if self.requests else 0
+        return f"requests: {self.requests} connections: {connections} reused: {reused:.0%}"
+
+    def close(self):
+        self.session.close()
+
+    def abort(self):
+        # Closes the session and shuts down the sockets of requests in flight, they fail right away
+        self.session.close()
+        for connection in list(self.opened):
+            sock = getattr(connection, "sock", None)
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+class ApiRecorder:
+    # Appends every Wallbox client call to a JSONL file, one compact line per call:
+    # {"t": start time, "d": duration, "m": method, "a": arguments, "r": result or "e": error}.
+    # Values of keys that look like credentials are replaced, datetimes are written as ISO strings.
+    scrubKeys = ("token", "password", "email", "authorization", "secret")
+    maxSize = 50 * 1024 * 1024  # Recording stops at this file size
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+        self.records = 0
+
+    @classmethod
+    def scrub(cls, value):
+        if isinstance(value, dict):
+            return {key: "***" if any(word in str(key).lower() for word in cls.scrubKeys) else cls.scrub(item)
+                    for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls.scrub(item) for item in value]
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        return value
+
+    def record(self, method, args, kwargs, started, duration, result=None, error=None):
+        entry = {"t": round(started, 3), "d": round(duration, 4), "m": method, "a": self.scrub(list(args))}
+        if kwargs:
+            entry["k"] = self.scrub(kwargs)
+        if error is None:
+            entry["r"] = self.scrub(result)
+        else:
+            response = getattr(error, "response", None)
+            entry["e"] = {"type": type(error).__name__, "message": str(error)}
+            if response is not None:
+                entry["e"]["status"] = response.status_code
+        line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size + len(line) > self.maxSize:
+                Domoticz.Error(f"API recording {self.path} reached {self.maxSize // (1024 * 1024)} MB, recording stopped")
+                self.close()
+                return
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+            self.records += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class WallboxAuth:
+    # Wraps the Wallbox client and keeps its JWT alive.
+    # Client methods are called through this object: the token is refreshed shortly
+    # before it expires, and a call answered with 401 triggers one new login and retry.
+    refreshMargin = 300         # Refresh the token this many seconds before expiry
+    defaultTokenLifetime = 3600 # Used when the client does not report the token ttl
+
+    def __init__(self, wallbox, metrics=None, transport=None, budget=None, recorder=None):
+        self.wallbox = wallbox
+        self.metrics = metrics
+        self.transport = transport
+        self.budget = budget
+        self.recorder = recorder
+        self.breaker = CircuitBreaker()
+        self.tokenExpiry = 0
+        self.logins = 0
+        self.loginsAvoided = 0
+        self.cancelled = False
+        self.lock = threading.RLock()
+
+    def login(self, force=True):
+        # force drops the cached token so the client signs in again with username/password,
+        # otherwise the client may use its refresh token. A client that would keep its token
+        # (drift smaller than refreshMargin) signs in again too. Only a new token counts as login.
+        with self.lock:
+            w = self.wallbox
+            if not force and w.jwtToken and w.jwtTokenTtl / 1000 - getattr(w, "jwtTokenDrift", 0) > time.time():
+                force = True
+            if force:
+                w.jwtToken = ""
+            token = w.jwtToken
+            self.timed("authenticate", w.authenticate)
+            if w.jwtToken != token:
+                self.logins += 1
+            ttl = getattr(w, "jwtTokenTtl", 0)
+            if ttl:
+                self.tokenExpiry = ttl / 1000
+            else:
+                self.tokenExpiry = time.time() + self.defaultTokenLifetime
+            logDebug("Wallbox login done, token valid until %s", datetime.datetime.fromtimestamp(self.tokenExpiry))
+
+    def restoreToken(self, token, ttl):
+        # Reuses a token saved by an earlier run, a 401 answer still triggers a new login
+        with self.lock:
+            if not token or ttl / 1000 < time.time() + self.refreshMargin:
+                return False
+            w = self.wallbox
+            w.jwtToken = token
+            w.jwtTokenTtl = ttl
+            if hasattr(w, "headers"):
+                w.headers["Authorization"] = f"Bearer {token}"
+            self.tokenExpiry = ttl / 1000
+            return True
+
+    def ensureToken(self):
+        with self.lock:
+            if time.time() < self.tokenExpiry - self.refreshMargin:
+                self.loginsAvoided += 1
+                return
+            self.login(force=self.tokenExpiry == 0)
+
+    def timed(self, method, function, *args, **kwargs):
+        if self.budget is not None:
+            self.budget.acquire(method)
+        if self.transport is not None:
+            self.transport.operation(method)
+        if self.metrics is None and self.recorder is None:
+            return function(*args, **kwargs)
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as err:
+            duration = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.observe("api", method, duration, error=True)
+            if self.recorder is not None:
+                self.recorder.record(method, args, kwargs, started, duration, error=err)
+            raise
+        duration = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.observe("api", method, duration)
+        if self.recorder is not None:
+            self.recorder.record(method, args, kwargs, started, duration, result=result)
+        return result
+
+    def cancel(self):
+        # New calls fail right away, calls in flight end at their read timeout
+        self.cancelled = True
+        if self.budget is not None:
+            self.budget.cancel()
+
+    def call(self, method, *args, **kwargs):
+        if self.cancelled:
+            raise requests.exceptions.ConnectionError(f"Plugin is stopping, {method} not called")
+        self.breaker.check()
+        try:
+            result = self.callOnce(method, *args, **kwargs)
+        except ThrottledError:
+            self.breaker.skipped()  # Not sent, says nothing about the cloud
+            raise
+        except Exception as err:
+            if self.chargerForbidden(method, args, err):
+                self.breaker.success()  # The cloud answered, only this charger is not accessible
+            else:
+                self.breaker.failure(err)
+            raise
+        self.breaker.success()
+        return result
+
+    def chargerForbidden(self, method, args, err):
+        # A 403 for one charger with a valid token, e.g. a charger removed from the account
+        return (isinstance(err, requests.exceptions.HTTPError) and err.response is not None
+                and err.response.status_code == 403 and method != "authenticate" and len(args) > 0
+                and bool(self.wallbox.jwtToken))
+
+    def callOnce(self, method, *args, **kwargs):
+        self.ensureToken()
+        try:
+            return self.timed(method, getattr(self.wallbox, method), *args, **kwargs)
+        except requests.exceptions.HTTPError as err:
+            if err.response is None or err.response.status_code != 401:
+                raise
+            Domoticz.Log(f"Wallbox {method}: authorization expired, login again")
+        self.login()
+        return self.timed(method, getattr(self.wallbox, method), *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.wallbox, name)
+        if not callable(attr):
+            return attr
+        def wrapper(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return wrapper
+
+    def stats(self):
+        return f"logins: {self.logins} logins avoided: {self.loginsAvoided}"
+
+class OcppServer:
+    # Minimal OCPP 1.6-J central system. Charge points connect to ws://<domoticz>:<port>/<chargerId>.
+    # Pushed StatusNotification, MeterValues and Start/StopTransaction messages are converted to the
+    # status format of the Wallbox cloud and passed to onPush(chargerId, status) from the server thread.
+    # Connections of charge points for which allowed(chargerId) is False are closed right away.
+    # websockets is imported here, so it is only needed when the OCPP mode is used.
+    statusIds = {
+        "Available": 161,       # READY
+        "Preparing": 180,       # WAITING
+        "Charging": 194,        # CHARGING
+        "SuspendedEV": 182,     # PAUSED
+        "SuspendedEVSE": 182,
+        "Finishing": 180,
+        "Reserved": 179,        # SCHEDULED
+        "Unavailable": 209,     # LOCKED
+        "Faulted": 14           # ERROR
+    }
+    CALL = 2
+    CALLRESULT = 3
+    CALLERROR = 4
+    callTimeout = 15
+    validId = re.compile(r"[A-Za-z0-9_.:-]{1,48}$")
+
+    def __init__(self, port, onPush, host="127.0.0.1", allowed=None):
+        import asyncio
+        import websockets
+        self.asyncio = asyncio
+        self.websockets = websockets
+        self.host = host
+        self.port = port
+        self.onPush = onPush
+        self.allowed = allowed
+        self.rejected = 0
+        self.chargePoints = {}          # chargerId -> charge point dict
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.nextTransactionId = int(time.time())
+        self.started = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(name="OcppThread", target=self.run)
+        self.thread.start()
+        self.started.wait(10)
+
+    def run(self):
+        self.loop = self.asyncio.new_event_loop()
+        self.asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(self.serve())
+            Domoticz.Log(f"OCPP central system listening on {self.host or 'all addresses'} port {self.port}")
+        except OSError as err:
+            Domoticz.Error(f"OCPP central system could not listen on port {self.port}: {err}")
+            self.started.set()
+            return
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def serve(self):
+        return await self.websockets.serve(self.handler, self.host, self.port, subprotocols=["ocpp1.6"])
+
+    async def shutdown(self, timeout=5):
+        self.server.close()
+        try:
+            await self.asyncio.wait_for(self.server.wait_closed(), timeout)
+        except self.asyncio.TimeoutError:
+            Domoticz.Error("OCPP central system did not close in time")
+        self.loop.stop()
+
+    def stop(self, timeout=10):
+        if self.loop is not None and self.loop.is_running():
+            self.asyncio.run_coroutine_threadsafe(self.shutdown(max(timeout - 0.5, 0.1)), self.loop)
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def isConnected(self, chargerId):
+        return str(chargerId) in self.chargePoints
+
+    def currentStatus(self, chargerId):
+        # Status of a connected charge point as last pushed, None when it is not connected
+        chargePoint = self.chargePoints.get(str(chargerId))
+        return None if chargePoint is None else self.status(chargePoint)
+
+    async def handler(self, websocket, path=None):
+        if path is None:
+            path = getattr(websocket, "path", None) or websocket.request.path
+        chargerId = path.strip("/").split("/")[-1]
+        if not self.validId.match(chargerId) or chargerId == WallboxPlugin.DIAGNOSTICSID or (self.allowed is not None and not self.allowed(chargerId)):
+            self.rejected += 1
+            Domoticz.Error(f"OCPP connection for unknown charge point {chargerId[:48]!r} from {websocket.remote_address} rejected")
+            await websocket.close(1008, "Unknown charge point")
+            return
+        chargePoint = {
+            "websocket": websocket,
+            "pending": {},
+            "status": "Available",
+            "locked": 0,
+            "power": 0.0,
+            "register": None,
+            "meterStart": None,
+            "transactionId": None,
+            "addedEnergy": 0.0,
+            "maxCurrent": 32,
+            "firmware": ""
+        }
+        self.chargePoints[chargerId] = chargePoint
+        Domoticz.Log(f"OCPP charge point {chargerId} connected")
+        try:
+            async for raw in websocket:
+                try:
+                    message = json.loads(raw)
+                    if message[0] == self.CALL:
+                        await self.handleCall(chargerId, chargePoint, message)
+                    elif message[0] in (self.CALLRESULT, self.CALLERROR):
+                        future = chargePoint["pending"].pop(message[1], None)
+                        if future is not None and not future.done():
+                            future.set_result(message)
+                except (ValueError, IndexError, KeyError, TypeError) as err:
+                    Domoticz.Error(f"OCPP charge point {chargerId} invalid message {raw}: {err}")
+        except self.websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if self.chargePoints.get(chargerId) is chargePoint:
+                del self.chargePoints[chargerId]
+            Domoticz.Log(f"OCPP charge point {chargerId} disconnected")
+
+    async def handleCall(self, chargerId, chargePoint, message):
+        uniqueId, action, payload = message[1], message[2], message[3]
+        logDebug("OCPP %s -> %s %s", chargerId, action, payload)
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        push = True
+        if action == "BootNotification":
+            chargePoint["firmware"] = payload.get("firmwareVersion", "")
+            response = {"status": "Accepted", "currentTime": now, "interval": 300}
+        elif action == "Heartbeat":
+            response = {"currentTime": now}
+            push = False
+        elif action == "StatusNotification":
+            if payload.get("connectorId", 1) != 0 or payload["status"] in ("Unavailable", "Faulted"):
+                chargePoint["status"] = payload["status"]
+            chargePoint["locked"] = 1 if chargePoint["status"] == "Unavailable" else 0
+            response = {}
+        elif action == "MeterValues":
+            self.readMeterValues(chargePoint, payload.get("meterValue", []))
+            response = {}
+        elif action == "StartTransaction":
+            self.nextTransactionId += 1
+            chargePoint["transactionId"] = self.nextTransactionId
+            chargePoint["meterStart"] = payload["meterStart"]
+            chargePoint["register"] = payload["meterStart"]
+            chargePoint["addedEnergy"] = 0.0
+            response = {"transactionId": self.nextTransactionId, "idTagInfo": {"status": "Accepted"}}
+        elif action == "StopTransaction":
+            if chargePoint["meterStart"] is not None:
+                chargePoint["addedEnergy"] = (payload["meterStop"] - chargePoint["meterStart"]) / 1000
+            chargePoint["transactionId"] = None
+            chargePoint["meterStart"] = None
+            chargePoint["power"] = 0.0
+            response = {"idTagInfo": {"status": "Accepted"}}
+        elif action in ("Authorize", "DataTransfer"):
+            response = {"idTagInfo": {"status": "Accepted"}} if action == "Authorize" else {"status": "Accepted"}
+            push = False
+        elif action in ("FirmwareStatusNotification", "DiagnosticsStatusNotification"):
+            response = {}
+            push = False
+        else:
+            await chargePoint["websocket"].send(json.dumps([self.CALLERROR, uniqueId, "NotImplemented", f"{action} not supported", {}]))
+            return
+        await chargePoint["websocket"].send(json.dumps([self.CALLRESULT, uniqueId, response]))
+        if push:
+            self.onPush(chargerId, self.status(chargePoint))
+
+    def readMeterValues(self, chargePoint, meterValues):
+        for meterValue in meterValues:
+            for sampledValue in meterValue.get("sampledValue", []):
+                measurand = sampledValue.get("measurand", "Energy.Active.Import.Register")
+                if sampledValue.get("phase"):
+                    continue
+                value = float(sampledValue["value"])
+                kilo = sampledValue.get("unit", "").startswith("k")
+                if measurand == "Power.Active.Import":
+                    chargePoint["power"] = value if kilo else value / 1000
+                elif measurand == "Energy.Active.Import.Register":
+                    register = value * 1000 if kilo else value
+                    chargePoint["register"] = register
+                    if chargePoint["meterStart"] is not None:
+                        chargePoint["addedEnergy"] = (register - chargePoint["meterStart"]) / 1000
+                elif measurand == "Current.Offered":
+                    chargePoint["maxCurrent"] = int(value)
+
+    def status(self, chargePoint):
+        # Same keys as the getChargerStatus response of the Wallbox cloud, energy in kWh, power in kW
+        return {
+            "status_id": self.statusIds.get(chargePoint["status"], 0),
+            "charging_power": chargePoint["power"],
+            "charging_speed": 0,
+            "added_range": 0,
+            "added_energy": chargePoint["addedEnergy"],
+            "added_green_energy": 0,
+            "added_grid_energy": chargePoint["addedEnergy"],
+            "last_sync": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "current_mode": 0,
+            "finished": chargePoint["transactionId"] is None,
+            "config_data": {
+                "locked": chargePoint["locked"],
+                "max_charging_current": chargePoint["maxCurrent"],
+                "software": {
+                    "updateAvailable": False,
+                    "currentVersion": chargePoint["firmware"],
+                    "latestVersion": chargePoint["firmware"]
+                }
+            }
+        }
+
+    async def sendCall(self, chargerId, action, payload):
+        chargePoint = self.chargePoints[chargerId]
+        self.nextTransactionId += 1
+        uniqueId = str(self.nextTransactionId)
+        future = self.loop.create_future()
+        chargePoint["pending"][uniqueId] = future
+        await chargePoint["websocket"].send(json.dumps([self.CALL, uniqueId, action, payload]))
+        try:
+            return await self.asyncio.wait_for(future, self.callTimeout)
+        finally:
+            chargePoint["pending"].pop(uniqueId, None)
+
+    def call(self, chargerId, action, payload):
+        # Called from other threads, returns the CALLRESULT payload or raises on CALLERROR
+        chargerId = str(chargerId)
+        if chargerId not in self.chargePoints:
+            raise Exception(f"OCPP charge point {chargerId} not connected")
+        future = self.asyncio.run_coroutine_threadsafe(self.sendCall(chargerId, action, payload), self.loop)
+        result = future.result(self.callTimeout + 1)
+        if result[0] == self.CALLERROR:
+            raise Exception(f"OCPP {action} failed: {result[2]} {result[3]}")
+        logDebug("OCPP %s <- %s %s", chargerId, action, result[2])
+        return result[2]
+
+    def command(self, chargerId, unit, command, level):
+        # onCommand paths of the plugin, by unit number
+        chargePoint = self.chargePoints[str(chargerId)]
+        if unit == WallboxPlugin.DEVICELOCK:
+            availability = "Inoperative" if command == "On" else "Operative"
+            return self.call(chargerId, "ChangeAvailability", {"connectorId": 0, "type": availability})
+        if unit in (WallboxPlugin.DEVICERESUME, WallboxPlugin.DEVICEPAUSE, WallboxPlugin.DEVICESTARTSTOP):
+            start = unit == WallboxPlugin.DEVICERESUME or (unit == WallboxPlugin.DEVICESTARTSTOP and command == "On")
+            if start:
+                if chargePoint["transactionId"] is not None:
+                    return None
+                return self.call(chargerId, "RemoteStartTransaction", {"connectorId": 1, "idTag": "Domoticz"})
+            if chargePoint["transactionId"] is None:
+                return None
+            return self.call(chargerId, "RemoteStopTransaction", {"transactionId": chargePoint["transactionId"]})
+        if unit == WallboxPlugin.DEVICESELECTHARGINGCURRENT:
+            # OCPP 1.6 has no standard configuration key for the current limit, use a charging profile
+            current = round(level)
+            result = self.call(chargerId, "SetChargingProfile", {
+                "connectorId": 0,
+                "csChargingProfiles": {
+                    "chargingProfileId": 1,
+                    "stackLevel": 0,
+                    "chargingProfilePurpose": "ChargePointMaxProfile",
+                    "chargingProfileKind": "Absolute",
+                    "chargingSchedule": {
+                        "chargingRateUnit": "A",
+                        "chargingSchedulePeriod": [{"startPeriod": 0, "limit": current}]
+                    }
+                }
+            })
+            if result.get("status") == "Accepted":
+                chargePoint["maxCurrent"] = current
+                self.onPush(str(chargerId), self.status(chargePoint))
+            return result
+        return None
+
+class SetpointWriter:
+    # Debounces the Select Max Charging Current slider. Every request is queued as a delayed
+    # Command with a serial number, only the latest serial per charger is written and only when
+    # it differs from the max charging current last confirmed by the charger.
+    debounce = 1.5
+
+    def __init__(self, messageQueue):
+        self.messageQueue = messageQueue
+        self.latest = {}        # chargerId -> serial of the latest request
+        self.confirmed = {}     # chargerId -> max charging current reported by the charger
+        self.serial = 0
+        self.applied = 0
+        self.superseded = 0
+        self.unchanged = 0
+        self.lock = threading.Lock()
+
+    def request(self, chargerId, unit, command, level):
+        with self.lock:
+            self.serial += 1
+            self.latest[str(chargerId)] = self.serial
+            serial = self.serial
+        self.messageQueue.putLater(
+            {"Type":"Command",
+             "DeviceID": chargerId,
+             "Unit": unit,
+             "Command": command,
+             "Level": level,
+             "Serial": serial
+            }, self.debounce)
+
+    def take(self, chargerId, serial, level):
+        # Returns True when this request must be written to the charger
+        with self.lock:
+            chargerId = str(chargerId)
+            if self.latest.get(chargerId) != serial:
+                self.superseded += 1
+                return False
+            del self.latest[chargerId]
+            if self.confirmed.get(chargerId) == round(level):
+                self.unchanged += 1
+                return False
+            self.applied += 1
+            return True
+
+    def isPending(self, chargerId):
+        with self.lock:
+            return str(chargerId) in self.latest
+
+    def confirm(self, chargerId, current):
+        # Called with the current the charger reported or accepted, never before a write succeeded
+        with self.lock:
+            self.confirmed[str(chargerId)] = current
+
+    def stats(self):
+        return f"applied: {self.applied} superseded: {self.superseded} unchanged: {self.unchanged}"
+
+class PollScheduler:
+    # Decides per charger when the next status update is due, based on the last seen status.
+    defaultInterval = 30
+    intervals = {
+        "CHARGING": 10,
+        "DISCHARGING": 10,
+        "WAITING": 30,
+        "PAUSED": 30,
+        "SCHEDULED": 60,
+        "UPDATING": 60,
+        "ERROR": 60,
+        "READY": 120,
+        "LOCKED": 300,
+        "DISCONNECTED": 300
+    }
+    idleStates = ("READY", "LOCKED", "DISCONNECTED")
+    idleBackoff = 1.5           # Interval multiplier for every poll an idle charger stays in the same state
+    maxIdleInterval = 900
+    commandInterval = 10        # Interval used directly after a command
+    commandBoostTime = 60       # How long the command interval is used
+
+    def __init__(self, intervals="", pollRate=None):
+        self.intervals = dict(self.intervals)
+        self.intervals.update(self.parseIntervals(intervals))
+        self.chargers = {}
+        self.pollRate = pollRate    # Polls per second available for all chargers, None is unlimited
+        self.scale = 1.0            # Interval multiplier when the chargers together need more than pollRate
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parseIntervals(text):
+        intervals = {}
+        for item in text.split(","):
+            if not item.strip():
+                continue
+            try:
+                state, seconds = item.split(":")
+                intervals[state.strip().upper()] = max(1, int(seconds))
+            except ValueError:
+                Domoticz.Error(f"Invalid poll interval: {item}")
+        return intervals
+
+    def add(self, chargerId):
+        with self.lock:
+            self.chargers[str(chargerId)] = {
+                "state": None,
+                "interval": self.defaultInterval,
+                "nextPoll": 0,
+                "boostUntil": 0
+            }
+
+    def remove(self, chargerId):
+        with self.lock:
+            self.chargers.pop(str(chargerId), None)
+
+    def due(self, now):
+        # Returns the chargers to poll now, and schedules their next poll
+        dueChargers = []
+        with self.lock:
+            self.rebalance()
+            for chargerId, charger in self.chargers.items():
+                if now >= charger["nextPoll"]:
+                    dueChargers.append(chargerId)
+                    charger["nextPoll"] = now + self.currentInterval(charger, now)
+        return dueChargers
+
+    def rebalance(self):
+        # Caller holds the lock. Stretches all intervals by the same factor when the planned polls
+        # exceed the budget, so every charger keeps its share according to its state.
+        if not self.pollRate:
+            return
+        demand = sum(1 / charger["interval"] for charger in self.chargers.values())
+        scale = max(1.0, demand / self.pollRate)
+        if abs(scale - self.scale) > 0.05:
+            Domoticz.Log(f"Poll intervals scaled by {scale:.2f} to stay within the API budget")
+        self.scale = scale
+
+    def currentInterval(self, charger, now):
+        if now < charger["boostUntil"]:
+            return min(self.commandInterval, charger["interval"] * self.scale)
+        return charger["interval"] * self.scale
+
+    def observe(self, chargerId, status):
+        # Called with the status name after every status update of a charger
+        with self.lock:
+            charger = self.chargers.get(str(chargerId))
+            if charger is None:
+                return
+            interval = self.intervals.get(status, self.defaultInterval)
+            if status == charger["state"] and status in self.idleStates:
+                interval = min(max(interval, charger["interval"] * self.idleBackoff), self.maxIdleInterval)
+            charger["state"] = status
+            charger["interval"] = interval
+            now = time.time()
+            charger["nextPoll"] = now + self.currentInterval(charger, now)
+
+    def commandSent(self, chargerId):
+        with self.lock:
+            charger = self.chargers.get(str(chargerId))
+            if charger is None:
+                return
+            now = time.time()
+            charger["boostUntil"] = now + self.commandBoostTime
+            charger["nextPoll"] = min(charger["nextPoll"], now + self.commandInterval)
+
+class CronSchedule:
+    # Cron style schedule "minute hour day month weekday", weekday 0 or 7 is Sunday.
+    # Fields accept *, numbers, ranges a-b, lists a,b and steps */n or a-b/n.
+    fields = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parseField(part, low, high) for part, (low, high) in zip(parts, self.fields))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.anyDay = parts[2] == "*"
+        self.anyWeekday = parts[4] == "*"
+
+    @staticmethod
+    def parseField(text, low, high):
+        values = set()
+        for item in text.split(","):
+            item, _, step = item.partition("/")
+            step = int(step) if step else 1
+            if item == "*":
+                start, end = low, high
+            elif "-" in item:
+                start, end = (int(value) for value in item.split("-"))
+            else:
+                start = end = int(item)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Cron field out of range {low}-{high}: {text}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def dayMatches(self, moment):
+        dayMatch = moment.day in self.days
+        weekdayMatch = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.anyDay or self.anyWeekday:
+            return dayMatch and weekdayMatch
+        return dayMatch or weekdayMatch     # Like cron: either field matches when both are restricted
+
+    def next(self, after):
+        # First local time after the datetime `after` matching the schedule
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.dayMatches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+class JobScheduler:
+    # Jobs with a cron schedule or an interval in seconds, kept in a heap on their next fire time.
+    # runDue only looks at the first job when nothing is due. A job whose fire time was missed,
+    # e.g. by a late heartbeat, runs once as soon as it is noticed and is then rescheduled.
+    lateWarning = 60            # Seconds late before a job run is logged as late
+
+    def __init__(self):
+        self.heap = []
+        self.jobs = {}          # name -> (schedule, action)
+        self.runs = {}          # name -> number of runs
+        self.sequence = 0
+        self.lock = threading.RLock()
+
+    def add(self, name, schedule, action):
+        # schedule: cron expression or seconds between runs
+        if isinstance(schedule, str):
+            schedule = CronSchedule(schedule)
+        with self.lock:
+            self.jobs[name] = (schedule, action)
+            self.runs[name] = 0
+            self.push(name, self.nextFire(schedule, time.time()))
+
+    def push(self, name, fireTime):
+        self.sequence += 1
+        heapq.heappush(self.heap, (fireTime, self.sequence, name))
+
+    @staticmethod
+    def nextFire(schedule, after):
+        if isinstance(schedule, CronSchedule):
+            return schedule.next(datetime.datetime.fromtimestamp(after)).timestamp()
+        return after + schedule
+
+    def runDue(self, now):
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                fireTime, sequence, name = heapq.heappop(self.heap)
+                schedule, action = self.jobs[name]
+                if now - fireTime > self.lateWarning:
+                    Domoticz.Log(f"Job {name} due at {datetime.datetime.fromtimestamp(fireTime):%Y-%m-%d %H:%M} runs late")
+                try:
+                    action()
+                except Exception as err:
+                    Domoticz.Error(f"Job {name} failed: {err}")
+                self.runs[name] += 1
+                self.push(name, self.nextFire(schedule, now))
+
+    def nextRun(self, name):
+        with self.lock:
+            return min((fireTime for fireTime, sequence, jobName in self.heap if jobName == name), default=None)
+
+class MessageQueue:
+    # Priority queue for wbThread messages with the queue.Queue put/get/task_done/join interface.
+    # Commands are handled before polls and polls before backfills, an Update for a charger
+    # that is still waiting in the queue is dropped. putLater queues a message after a delay.
+    priorities = {
+        "Command": 0,
+        "Update": 1,
+        "Backfill": 2,
+        "Discover": 2,
+        "Metrics": 2
+    }
+    defaultPriority = 1
+    stopPriority = 3            # The None stop message is handled after everything else
+
+    def __init__(self):
+        self.heap = []
+        self.delayed = []       # (due time, sequence, message) of messages queued by putLater
+        self.sequence = 0
+        self.pendingUpdates = set()
+        self.unfinished = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.coalesced = 0
+        self.maxDepth = 0
+        self.waitTimes = {}     # Type -> [count, total wait, max wait]
+
+    def put(self, message):
+        with self.condition:
+            if self.closed:
+                return
+            self.push(message)
+            self.condition.notify()
+
+    def putLater(self, message, delay):
+        with self.condition:
+            if self.closed:
+                return
+            self.sequence += 1
+            heapq.heappush(self.delayed, (time.time() + delay, self.sequence, message))
+            self.condition.notify()
+
+    def push(self, message):
+        # Caller holds the condition
+        if message is None:
+            priority = self.stopPriority
+        else:
+            if message["Type"] == "Update":
+                key = message.get("DeviceID")
+                if key in self.pendingUpdates:
+                    self.coalesced += 1
+                    return
+                self.pendingUpdates.add(key)
+            priority = self.priorities.get(message["Type"], self.defaultPriority)
+        self.sequence += 1
+        heapq.heappush(self.heap, (priority, self.sequence, time.time(), message))
+        self.unfinished += 1
+        self.maxDepth = max(self.maxDepth, len(self.heap))
+
+    def promoteDelayed(self):
+        # Caller holds the condition, returns the seconds until the next delayed message is due
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            due, sequence, message = heapq.heappop(self.delayed)
+            self.push(message)
+        if self.delayed:
+            return self.delayed[0][0] - now
+        return None
+
+    def get(self, block=True):
+        with self.condition:
+            while True:
+                timeout = self.promoteDelayed()
+                if self.heap:
+                    break
+                if not block:
+                    raise IndexError("MessageQueue is empty")
+                self.condition.wait(timeout)
+            priority, sequence, queued, message = heapq.heappop(self.heap)
+            messageType = "Stop"
+            if message is not None:
+                messageType = message["Type"]
+                if messageType == "Update":
+                    self.pendingUpdates.discard(message.get("DeviceID"))
+            wait = time.time() - queued
+            stats = self.waitTimes.setdefault(messageType, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            return message
+
+    def takeUpdates(self):
+        # Removes all queued Update messages, so they can be handled in one batch.
+        # task_done must be called for every returned message.
+        with self.condition:
+            updates = [entry for entry in self.heap if entry[3] is not None and entry[3]["Type"] == "Update"]
+            if not updates:
+                return []
+            self.heap = [entry for entry in self.heap if entry[3] is None or entry[3]["Type"] != "Update"]
+            heapq.heapify(self.heap)
+            now = time.time()
+            stats = self.waitTimes.setdefault("Update", [0, 0.0, 0.0])
+            for entry in updates:
+                self.pendingUpdates.discard(entry[3].get("DeviceID"))
+                stats[0] += 1
+                stats[1] += now - entry[2]
+                stats[2] = max(stats[2], now - entry[2])
+            return [entry[3] for entry in sorted(updates)]
+
+    def close(self):
+        # Drops the queued and delayed messages, queues the stop message and refuses new messages.
+        # Returns the number of dropped messages.
+        with self.condition:
+            dropped = len(self.heap) + len(self.delayed)
+            self.unfinished -= len(self.heap)
+            self.heap = []
+            self.delayed = []
+            self.pendingUpdates.clear()
+            self.closed = True
+            self.push(None)
+            self.condition.notify_all()
+            return dropped
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.unfinished = 0
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def qsize(self):
+        with self.condition:
+            return len(self.heap)
+
+    def stats(self):
+        with self.condition:
+            waits = " ".join(f"{messageType}: {count}x avg {total / count:.2f}s max {maximum:.2f}s"
+                             for messageType, (count, total, maximum) in self.waitTimes.items())
+            return f"depth: {len(self.heap)} delayed: {len(self.delayed)} max depth: {self.maxDepth} coalesced: {self.coalesced} waits {waits}"
+
+class Profiler:
+    # Sampled cProfile of the worker thread tasks and tracemalloc snapshots.
+    # write() dumps the top hotspots since the last dump and the allocation growth since
+    # the previous snapshot to a profile_<time>.txt file, the last `keep` files are kept.
+    sampleRate = 0.1            # Part of the tasks that is profiled
+    topCount = 25
+    traceFrames = 10
+    keep = 10
+
+    def __init__(self, folder):
+        import cProfile, io, pstats, tracemalloc
+        self.cProfile = cProfile
+        self.io = io
+        self.pstats = pstats
+        self.tracemalloc = tracemalloc
+        self.folder = folder
+        self.profile = cProfile.Profile()
+        self.active = False
+        self.tasks = {}         # message type -> profiled tasks since the last dump
+        self.lastSnapshot = None
+        self.random = random.Random()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceFrames)
+
+    def begin(self, messageType):
+        if self.active or self.random.random() >= self.sampleRate:
+            return
+        try:
+            self.profile.enable()
+        except ValueError:      # Another profiler is active in this interpreter
+            return
+        self.active = True
+        self.tasks[messageType] = self.tasks.get(messageType, 0) + 1
+
+    def end(self):
+        if self.active:
+            self.profile.disable()
+            self.active = False
+
+    def snapshot(self):
+        return self.tracemalloc.take_snapshot().filter_traces((
+            self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+            self.tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")
+        ))
+
+    def write(self):
+        # Returns the path of the written file
+        self.end()
+        now = datetime.datetime.now()
+        out = self.io.StringIO()
+        current, peak = self.tracemalloc.get_traced_memory()
+        out.write(f"Wallbox plugin profile {now:%Y-%m-%d %H:%M:%S}\n")
+        out.write(f"Traced memory: {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB\n")
+        out.write(f"Profiled tasks: {', '.join(f'{messageType}: {count}' for messageType, count in sorted(self.tasks.items())) or 'none'}\n\n")
+
+        out.write(f"== Top {self.topCount} hotspots by cumulative time ==\n")
+        if self.tasks:
+            stats = self.pstats.Stats(self.profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(self.topCount)
+        snapshot = self.snapshot()
+        if self.lastSnapshot is None:
+            out.write(f"== Top {self.topCount} allocations ==\n")
+            for statistic in snapshot.statistics("lineno")[:self.topCount]:
+                out.write(f"{statistic}\n")
+        else:
+            out.write(f"== Top {self.topCount} allocation changes since the previous profile ==\n")
+            for statistic in snapshot.compare_to(self.lastSnapshot, "lineno")[:self.topCount]:
+                out.write(f"{statistic}\n")
+        self.lastSnapshot = snapshot
+        self.profile = self.cProfile.Profile()
+        self.tasks = {}
+
+        path = os.path.join(self.folder, f"profile_{now:%Y%m%d_%H%M%S}.txt")
+        with open(path, "w") as f:
+            f.write(out.getvalue())
+        profiles = sorted(name for name in os.listdir(self.folder) if name.startswith("profile_") and name.endswith(".txt"))
+        for name in profiles[:-self.keep]:
+            os.remove(os.path.join(self.folder, name))
+        return path
+
+    def stop(self):
+        self.end()
+        if self.tracemalloc.is_tracing():
+            self.tracemalloc.stop()
+
+class ChargerState:
+    # Values kept between status updates of one charger
+    def __init__(self, chargerId):
+        self.chargerId = str(chargerId)
+        self.lastValue = 0
+        self.totalEnergy = 0
+        self.totalGreenEnergy = 0      # We will be using this to calculate GREEN energy
+        self.pluginJustStarted = True  # Used to prevent dual entries set to True if plugin starts!
+        self.lastWritten = {}          # unit -> values last written by syncUnits
+        self.lastTouched = {}          # unit -> time of the last Update or Touch
+        self.unitWrites = 0
+        self.unitWritesSaved = 0
+        self.timedOut = None           # TimedOut value last set on the units, None if unknown
+        self.lastStatus = None         # Last getChargerStatus result
+        self.pending = {}              # unit -> optimistic values of a command, see WallboxPlugin.applyOptimistic
+
+    def restore(self, stored):
+        # Values saved in the snapshot by an earlier run
+        self.totalEnergy = stored.get("totalEnergy", 0)
+        self.totalGreenEnergy = stored.get("totalGreenEnergy", 0)
+        self.lastStatus = stored.get("lastStatus")
+        if self.lastStatus is not None:
+            self.lastValue = stored.get("lastValue", 0)
+            self.pluginJustStarted = False
+
+    def saved(self):
+        return {
+            "lastValue": self.lastValue,
+            "totalEnergy": self.totalEnergy,
+            "totalGreenEnergy": self.totalGreenEnergy,
+            "lastStatus": self.lastStatus
+        }
+
 class WallboxPlugin:
     enabled = False
     DEVICELOCK = 1
@@ -93,17 +1699,53 @@ class WallboxPlugin:
     DEVICETOTALGREENCOUNTER = 11
     DEVICEMAXCHARGINGCURRENT = 12
     DEVICESELECTHARGINGCURRENT = 13
+    DEVICESESSIONGREENENERGY = 14
+    livenessUnits = (DEVICESTATUS, DEVICECURRENT, DEVICETOTALENERGY)
+    # Command unit -> unit showing the expected result until the next status update
+    optimisticUnits = {DEVICELOCK: DEVICELOCK, DEVICERESUME: DEVICESTARTSTOP, DEVICEPAUSE: DEVICESTARTSTOP,
+                       DEVICESTARTSTOP: DEVICESTARTSTOP, DEVICESELECTHARGINGCURRENT: DEVICESELECTHARGINGCURRENT}
+    pendingSuffix = " (pending)"
+    pendingTimeout = 60            # Seconds before an optimistic value is reconciled anyway
+    DIAGNOSTICSID = "WallboxDiagnostics"
+    DIAGSUMMARY = 1
+    DIAGQUEUEDEPTH = 2
+    DIAGAPILATENCY = 3
+    DIAGAPIERRORS = 4
+    DIAGPROFILE = 5
+    touchInterval = 300            # Touch unchanged liveness units every touchInterval seconds
+    threadNames = ("QueueThread", "PollThread", "OcppThread")  # Name prefixes of the threads of the plugin
 
     def __init__(self):
-        self.messageQueue = queue.Queue()
-        self.countDownInit = 3         # Update devices every countDownInit * 10 seconds
+        self.messageQueue = MessageQueue()
+        self.pollScheduler = PollScheduler()
         self.chargerList = []
-        self.countDown = 1
-        self.lastValue = 0
-        self.totalEnergy = 0
-        self.totalGreenEnergy = 0      # We will be using this to calculate GREEN energy
-        self.pluginJustStarted = True  # Used to prevent dual entries set to True if plugin starts!
-        self.lastRunDate = "1990-01-01"
+        self.chargers = {}             # chargerId -> ChargerState
+        self.maxPollWorkers = 8        # Max number of chargers polled in parallel
+        self.commandSettleTime = 2     # Seconds before checking the charger status after a command
+        self.stopping = threading.Event()
+        self.unitLock = threading.RLock()  # Unit writes from onCommand and from wbThread
+        self.stopTimeout = 3           # Seconds onStop waits for the threads of the plugin
+        self.metrics = Metrics()
+        self.metricsInterval = 60      # Seconds between diagnostic device (and metrics file) updates
+        self.rediscoverySchedule = "30 4 * * *"   # Cron schedule of the charger list refresh
+        self.lastApiTotals = (0, 0.0, 0)
+        self.diagnosticsState = ChargerState(self.DIAGNOSTICSID)
+        self.pollPool = None
+        self.ocpp = None               # OcppServer when an OCPP port is configured
+        self.setpointWriter = SetpointWriter(self.messageQueue)
+        self.sessions = None           # SessionDatabase, opened on first use
+        self.transport = None          # HttpTransport used by the Wallbox client
+        self.budget = None             # ApiBudget shared by all Wallbox calls
+        self.throttleRetry = 30        # Seconds before a backfill refused by the budget is tried again
+        self.recorder = None           # ApiRecorder when API traffic is recorded
+        self.profiler = None           # Profiler when the worker is profiled
+        self.profileInterval = 3600    # Seconds between profile files
+        self.jobs = None               # JobScheduler, started by wbThread
+        self.rebuildHistory = False
+        self.historyStart = datetime.datetime(2015, 1, 1)  # Sessions are downloaded from this date
+        self.sessionOverlap = 86400    # Seconds downloaded again before syncedUntil, for sessions that were still running
+        self.snapshotInterval = 300     # Seconds between snapshot saves
+        self.nextSnapshot = 0
 
     def wbThread(self):
         Domoticz.Log('Start Wallbox thread')
@@ -132,25 +1774,70 @@ class WallboxPlugin:
             Domoticz.Error(f"Invalid startminute (0-59): {self.startminute}")
             return
         
-        self.wallbox = Wallbox(Parameters["Username"], Parameters["Password"])
+        self.rebuildHistory = Parameters["Mode4"] == "1"
+        # BUDGET in the poll intervals is the number of Wallbox requests per minute
+        self.budget = ApiBudget(PollScheduler.parseIntervals(Parameters["Mode5"]).get("BUDGET", ApiBudget.defaultRate))
+        self.pollScheduler = PollScheduler(Parameters["Mode5"], self.budget.pollRate())
+
+        ocppPort = Parameters.get("Port", "").strip()
+        if ocppPort.isdigit() and int(ocppPort) > 0:
+            try:
+                self.ocpp = OcppServer(int(ocppPort), self.onOcppPush, host=Parameters.get("Address", "").strip() or None, allowed=self.knownCharger)
+                self.ocpp.start()
+            except ImportError:
+                Domoticz.Error("OCPP mode needs the websockets package: sudo pip install websockets")
+
+        # With the drift the client refreshes its token refreshMargin seconds before expiry
+        client = Wallbox(Parameters["Username"], Parameters["Password"], jwtTokenDrift=WallboxAuth.refreshMargin)
+        self.transport = HttpTransport(poolSize=self.maxPollWorkers)
+        if not self.transport.install(client):
+            self.transport = None
+        if profilingEnabled():
+            self.profiler = Profiler(Parameters["HomeFolder"])
+            Domoticz.Log("Profiling the worker thread")
+        if recordingEnabled():
+            try:
+                self.recorder = ApiRecorder(os.path.join(Parameters["HomeFolder"], "apitraffic.jsonl"))
+                Domoticz.Log(f"Recording Wallbox API traffic to {self.recorder.path}")
+            except OSError as err:
+                Domoticz.Error(f"Unable to record API traffic: {err}")
+        self.wallbox = WallboxAuth(client, self.metrics, self.transport, self.budget, self.recorder)
         w=self.wallbox
         self.authenticated = False
-        try:
-            w.authenticate()
-        except:
-            Domoticz.Error('Wallbox authentication problem. Check username password')
-            return
-
-        self.authenticated = True
-        if self.debugging:
-            self.debugpy.breakpoint()
-
-        self.chargerList = w.getChargersList()
-        if len(self.chargerList):
+        snapshot = Snapshot(Parameters["HomeFolder"])
+        if snapshot.load() and snapshot["username"] == Parameters["Username"]:
+            # Warm start: serve the saved chargers right away, login and discovery happen in the background
+            Domoticz.Log(f"Warm start with {len(snapshot['chargers'])} charger(s) from {snapshot.path}")
+            self.authenticated = w.restoreToken(snapshot["token"], snapshot["tokenTtl"])
+            self.chargerList = snapshot["chargers"]
             for chargerId in self.chargerList:
-                self.initDevices(chargerId)
+                self.addCharger(chargerId, snapshot["states"].get(str(chargerId), {}))
+            self.messageQueue.put({"Type":"Discover"})
         else:
+            try:
+                w.login()
+                self.authenticated = True
+            except:
+                Domoticz.Error('Wallbox authentication problem. Check username password')
+                if self.ocpp is None:
+                    return
+                Domoticz.Log('Continuing with OCPP charge points only')
+
+            if self.debugging:
+                self.debugpy.breakpoint()
+
+            if self.authenticated:
+                self.chargerList = w.getChargersList()
+                for chargerId in self.chargerList:
+                    self.addCharger(chargerId)
+        if len(self.chargerList):
+            # First live poll before the backfills queued by addCharger
+            self.messageQueue.put({"Type":"Update"})
+        elif self.ocpp is None:
             Domoticz.Log('No charger configured.')
+        self.initDiagnostics()
+        self.nextSnapshot = time.time() + self.snapshotInterval
+        self.startJobs()
 
         Domoticz.Debug("Entering message handler")
         while True:
@@ -161,22 +1848,99 @@ class WallboxPlugin:
 
                 if Message is None:
                     Domoticz.Debug("Exiting message handler")
+                    self.saveSnapshot()
                     self.messageQueue.task_done()
                     break
 
                 dumpJson('Message', Message)
-                try:
-                    w.authenticate()
-                except:
-                    Domoticz.Error('Wallbox authentication problem. Check username password')
-                    raise("Authentication problem")
+                taskStart = time.perf_counter()
+                taskError = False
+                if Message["Type"] == "Metrics":
+                    self.writeMetrics()
+                    self.messageQueue.task_done()
+                    continue
+                if Message["Type"] == "Profile":
+                    self.writeProfile()
+                    self.messageQueue.task_done()
+                    continue
+                if self.profiler is not None:
+                    self.profiler.begin(Message["Type"])
 
                 if (Message["Type"] == "Update"):
-                    for chargerId in self.chargerList:
-                        self.updateDevices(str(chargerId))
+                    # Handle all queued updates at once, so the chargers are polled in parallel
+                    batch = [Message] + self.messageQueue.takeUpdates()
+                    chargerIds = []
+                    for update in batch:
+                        if "DeviceID" in update:
+                            chargerIds.append(str(update["DeviceID"]))
+                        else:
+                            chargerIds.extend(str(chargerId) for chargerId in self.chargerList)
+                    self.pollChargers(list(dict.fromkeys(chargerIds)))
+                    for update in batch[1:]:
+                        self.messageQueue.task_done()
+                    if debugEnabled():
+                        # The stats are only built when they are logged
+                        logDebug("Wallbox authentication %s", w.stats())
+                        logDebug("Message queue %s", self.messageQueue.stats())
+                        if self.transport is not None:
+                            logDebug("HTTP %s", self.transport.stats())
+                        logDebug("API budget %s poll interval scale %.2f", self.budget.stats(), self.pollScheduler.scale)
+                    if time.time() >= self.nextSnapshot:
+                        self.saveSnapshot()
+                elif (Message["Type"] == "Backfill"):
+                    chargerId = Message["DeviceID"]
+                    Domoticz.Log(f"Running scheduled task for charger {chargerId} to fill historic energy data...")
+                    try:
+                        self.fillHistoricEnergyData(chargerId, fullRebuild=Message.get("FullRebuild", False))
+                    except ThrottledError as err:
+                        logDebug("Backfill charger %s postponed: %s", chargerId, err)
+                        # A rebuild continues from the saved syncedUntil instead of starting over
+                        self.messageQueue.putLater(dict(Message, FullRebuild=False), self.throttleRetry)
+                    except Exception as err:
+                        taskError = True
+                        Domoticz.Error(f"Backfill error charger {chargerId}: {err}")
+                elif (Message["Type"] == "Discover"):
+                    try:
+                        self.discoverChargers()
+                    except ThrottledError as err:
+                        logDebug("Charger discovery postponed: %s", err)
+                        self.messageQueue.putLater(Message, self.throttleRetry)
+                    except Exception as err:
+                        taskError = True
+                        Domoticz.Error(f"Charger discovery error: {err}")
+                elif (Message["Type"] == "Push") and str(Message["DeviceID"]) == self.DIAGNOSTICSID:
+                    Domoticz.Error(f"OCPP status for reserved id {self.DIAGNOSTICSID} ignored")
+                elif (Message["Type"] == "Push"):
+                    chargerId = str(Message["DeviceID"])
+                    try:
+                        if chargerId not in self.chargers:
+                            Domoticz.Log(f"New OCPP charge point {chargerId}")
+                            self.chargers[chargerId] = ChargerState(chargerId)
+                            self.initDevices(chargerId, backfill=chargerId in [str(cloudId) for cloudId in self.chargerList])
+                        # A Push without status, queued after a command, repeats the current status
+                        status = Message.get("Status") or (self.ocpp.currentStatus(chargerId) if self.ocpp is not None else None)
+                        if status is not None:
+                            self.updateDevices(chargerId, status)
+                    except Exception as err:
+                        taskError = True
+                        Domoticz.Error(f"OCPP update error charger {chargerId}: {err}")
+                elif (Message["Type"] == "Command") and "Serial" in Message and not self.setpointWriter.take(Message["DeviceID"], Message["Serial"], Message["Level"]):
+                    logDebug("Max charging current %s for %s skipped, setpoints %s", Message["Level"], Message["DeviceID"], self.setpointWriter.stats())
+                    if not self.setpointWriter.isPending(Message["DeviceID"]):
+                        self.commandDone(Message["DeviceID"], Message["Unit"])
+                elif (Message["Type"] == "Command") and self.ocpp is not None and self.ocpp.isConnected(Message["DeviceID"]):
+                    try:
+                        res = self.ocpp.command(Message["DeviceID"], Message["Unit"], Message["Command"], Message["Level"])
+                        dumpJson('Result', res)
+                        self.commandDone(Message["DeviceID"], Message["Unit"])
+                    except Exception as err:
+                        taskError = True
+                        Domoticz.Error("Command error: "+str(err))
+                        self.commandFailed(Message["DeviceID"], Message["Unit"])
                 elif (Message["Type"] == "Command"):
                     deviceID = Message["DeviceID"]
                     try: 
+                        done = True
                         if Message["Unit"]==1:
                             if Message["Command"]=='Off':
                                 res=w.unlockCharger(deviceID)
@@ -185,9 +1949,7 @@ class WallboxPlugin:
                             dumpJson('Result', res)
                             try:
                                 locked = res["data"]["chargerData"]["locked"]
-                                myUnit = Devices[deviceID].Units[1]
-                                myUnit.nValue = locked
-                                myUnit.Update(Log=True)
+                                self.syncUnits(deviceID, {self.DEVICELOCK: ({"nValue": locked}, True)})
 
                             except:
                                 Domoticz.Debug('Unexpected response data, no locked info')
@@ -202,43 +1964,287 @@ class WallboxPlugin:
                             Domoticz.Debug('Set mew Max Charging to: ' + str(desiredmaxchargecurrent))
                             res=w.setMaxChargingCurrent(deviceID, desiredmaxchargecurrent)
                             dumpJson('Result', res)
+                            self.setpointWriter.confirm(deviceID, desiredmaxchargecurrent)
                         elif Message["Unit"]==6: #Charging start stop
-                            chargerStatus = w.getChargerStatus(deviceID)
-                            dumpJson('Status: ', chargerStatus)
-                            chargingStatus = Statuses(chargerStatus["status_id"])
-                            stateUpdated = False
-                            if Message["Command"]=='On':
-                                if chargingStatus== Statuses.LOCKED:
-                                    res=w.unlockCharger(deviceID)
-                                    dumpJson('Unlock: ', res)
-                                    time.sleep(2)
-                                    chargerStatus = w.getChargerStatus(deviceID)
-                                    dumpJson('Status: ', chargerStatus)
-                                    chargingStatus = Statuses(chargerStatus["status_id"])
-                                    stateUpdated = True
-                                if chargingStatus != Statuses.CHARGING:
-                                    res=w.resumeChargingSession(deviceID)
-                                    dumpJson('Resume: ', res)
-                                    stateUpdated = True
-                            else:
-                                if chargingStatus == Statuses.CHARGING:
-                                    res=w.pauseChargingSession(deviceID)
-                                    dumpJson('Pause: ', res)
-                                    stateUpdated = True
-                            if stateUpdated:
-                                time.sleep(2)
-                                self.updateDevices(deviceID)
+                            done = self.startStopCharging(deviceID, Message["Command"], Message.get("Step", "Start"))
+                        if done:
+                            self.commandDone(deviceID, Message["Unit"])
                     except Exception as err:
+                        taskError = True
                         Domoticz.Error("Command error: "+str(err))
+                        self.commandFailed(deviceID, Message["Unit"])
                 elif (Message["Status"] == "Error"):
                     Domoticz.Status("handleMessage: '"+Message["Text"]+"'.")
                     #if 401 client error, then probably authorization expired.
                 elif (Message["Type"] == "Error"):
                     Domoticz.Error("handleMessage: '"+Message["Text"]+"'.")
+                if self.profiler is not None:
+                    self.profiler.end()
+                self.metrics.observe("task", Message["Type"], time.perf_counter() - taskStart, taskError)
                 self.messageQueue.task_done()
 
             except Exception as err:
+                if self.profiler is not None:
+                    self.profiler.end()
                 Domoticz.Error("handleMessage: "+str(err))
+                self.messageQueue.task_done()
+
+    def addCharger(self, chargerId, stored=None):
+        # Creates the state and missing units of a charger and queues its history backfill
+        state = ChargerState(chargerId)
+        if stored:
+            state.restore(stored)
+        else:
+            store = SessionStore(Parameters["HomeFolder"], chargerId)
+            state.totalEnergy = store["totalEnergy"]
+            state.totalGreenEnergy = store["totalGreenEnergy"]
+        self.chargers[str(chargerId)] = state
+        self.initDevices(chargerId, backfill=False)
+        self.pollScheduler.add(chargerId)
+        if state.lastStatus is not None:
+            self.pollScheduler.observe(str(chargerId), Statuses(state.lastStatus["status_id"]).name)
+        if self.pollPool is None:
+            self.pollPool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.maxPollWorkers,
+                thread_name_prefix="PollThread")
+        self.messageQueue.put(
+            {"Type":"Backfill",
+             "DeviceID": str(chargerId),
+             "FullRebuild": self.rebuildHistory
+            })
+
+    def discoverChargers(self):
+        # Compares the cloud charger list with the one from the snapshot
+        chargerList = self.wallbox.getChargersList()
+        self.authenticated = True
+        known = [str(chargerId) for chargerId in self.chargerList]
+        for chargerId in chargerList:
+            if str(chargerId) not in known:
+                Domoticz.Log(f"New charger {chargerId}")
+                self.addCharger(chargerId)
+                self.messageQueue.put({"Type":"Update", "DeviceID": str(chargerId)})
+        for chargerId in known:
+            if chargerId not in [str(cloudId) for cloudId in chargerList]:
+                # No longer polled, the devices stay in Domoticz marked as timed out
+                Domoticz.Log(f"Charger {chargerId} no longer in the Wallbox account, polling stopped")
+                self.pollScheduler.remove(chargerId)
+                self.markTimedOut(chargerId, 1)
+                self.chargers.pop(chargerId, None)
+        self.chargerList = chargerList
+        self.saveSnapshot()
+
+    def saveSnapshot(self):
+        self.nextSnapshot = time.time() + self.snapshotInterval
+        if not self.chargerList:
+            return
+        snapshot = Snapshot(Parameters["HomeFolder"])
+        snapshot["username"] = Parameters["Username"]
+        snapshot["chargers"] = self.chargerList
+        w = self.wallbox.wallbox
+        if self.wallbox.tokenExpiry:
+            snapshot["token"] = w.jwtToken
+            snapshot["tokenTtl"] = w.jwtTokenTtl
+        snapshot["states"] = {str(chargerId): self.chargers[str(chargerId)].saved()
+                              for chargerId in self.chargerList if str(chargerId) in self.chargers}
+        try:
+            snapshot.save()
+        except OSError as err:
+            Domoticz.Error(f"Unable to save snapshot {snapshot.path}: {err}")
+
+    def initDiagnostics(self):
+        # Plugin wide diagnostic device, created unused so it only shows when enabled by the user
+        diagnosticUnits = [
+            {"Unit": self.DIAGSUMMARY, "Name": "Diagnostics", "Type": 243, "Subtype": 19},
+            {"Unit": self.DIAGQUEUEDEPTH, "Name": "Queue depth", "Type": 243, "Subtype": 31},
+            {"Unit": self.DIAGAPILATENCY, "Name": "API latency", "Type": 243, "Subtype": 31,
+             "Options": {"Custom": "1;ms"}},
+            {"Unit": self.DIAGAPIERRORS, "Name": "API errors", "Type": 243, "Subtype": 31},
+            {"Unit": self.DIAGPROFILE, "Name": "Write profile", "Type": 244, "Switchtype": 9}
+        ]
+        units = Devices[self.DIAGNOSTICSID].Units if self.DIAGNOSTICSID in Devices else {}
+        for diagnosticUnit in diagnosticUnits:
+            if diagnosticUnit["Unit"] not in units:
+                Domoticz.Unit(DeviceID=self.DIAGNOSTICSID, Used=0, **diagnosticUnit).Create()
+
+    def writeProfile(self):
+        if self.profiler is None:
+            Domoticz.Log("Profiling is off, select Profile worker as Debug option")
+            return
+        try:
+            Domoticz.Log(f"Profile written to {self.profiler.write()}")
+        except OSError as err:
+            Domoticz.Error(f"Unable to write profile: {err}")
+
+    def writeMetricsFile(self):
+        # Writes metrics.prom in the plugin folder
+        unitWrites = sum(state.unitWrites for state in self.chargers.values())
+        unitWritesSaved = sum(state.unitWritesSaved for state in self.chargers.values())
+        wallbox = getattr(self, "wallbox", None)
+        gauges = [
+            ("wallbox_queue_depth", "gauge", "Messages waiting for the worker thread", self.messageQueue.qsize()),
+            ("wallbox_queue_coalesced_total", "counter", "Update messages dropped as duplicate", self.messageQueue.coalesced),
+            ("wallbox_unit_writes_total", "counter", "Domoticz unit updates", unitWrites),
+            ("wallbox_unit_writes_saved_total", "counter", "Domoticz unit updates skipped as unchanged", unitWritesSaved)
+        ]
+        if wallbox is not None:
+            gauges.append(("wallbox_logins_total", "counter", "Wallbox logins", wallbox.logins))
+            gauges.append(("wallbox_logins_avoided_total", "counter", "Wallbox logins avoided by the cached token", wallbox.loginsAvoided))
+            gauges.append(("wallbox_setpoints_applied_total", "counter", "Max charging current setpoints written", self.setpointWriter.applied))
+            gauges.append(("wallbox_setpoints_superseded_total", "counter", "Max charging current setpoints replaced by a later one", self.setpointWriter.superseded))
+            gauges.append(("wallbox_circuit_open", "gauge", "1 when calls to the Wallbox cloud are suspended", int(wallbox.breaker.isOpen())))
+        if self.budget is not None:
+            gauges.append(("wallbox_api_budget_tokens", "gauge", "Requests left in the API budget bucket", round(self.budget.level(), 2)))
+            gauges.append(("wallbox_api_budget_used_total", "counter", "Requests taken from the API budget", sum(self.budget.used.values())))
+            gauges.append(("wallbox_api_throttled_total", "counter", "Requests delayed or refused by the API budget", sum(self.budget.throttled.values())))
+            gauges.append(("wallbox_poll_interval_scale", "gauge", "Poll interval multiplier applied to stay within the API budget", round(self.pollScheduler.scale, 2)))
+        if self.transport is not None:
+            gauges.append(("wallbox_http_requests_total", "counter", "HTTP requests to the Wallbox cloud", self.transport.requests))
+            gauges.append(("wallbox_http_connections_total", "counter", "HTTP connections opened to the Wallbox cloud", self.transport.connections()))
+        try:
+            self.metrics.write(os.path.join(Parameters["HomeFolder"], "metrics.prom"), gauges)
+        except OSError as err:
+            Domoticz.Error(f"Unable to write metrics file: {err}")
+
+    def writeMetrics(self):
+        # Updates the diagnostic device values, and metrics.prom when enabled in Debug
+        if metricsFileEnabled():
+            self.writeMetricsFile()
+
+        count, seconds, errors = self.metrics.totals("api")
+        lastCount, lastSeconds, lastErrors = self.lastApiTotals
+        self.lastApiTotals = (count, seconds, errors)
+        calls = count - lastCount
+        latency = round((seconds - lastSeconds) / calls * 1000) if calls else 0
+        if self.DIAGNOSTICSID not in Devices:
+            return
+        units = {
+            self.DIAGSUMMARY: ({"sValue": f"API calls: {count} errors: {errors}\nQueue {self.messageQueue.stats()}"}, False),
+            self.DIAGQUEUEDEPTH: ({"sValue": str(self.messageQueue.qsize())}, True),
+            self.DIAGAPILATENCY: ({"sValue": str(latency)}, True),
+            self.DIAGAPIERRORS: ({"sValue": str(errors - lastErrors)}, True)
+        }
+        self.syncUnits(self.DIAGNOSTICSID, units, self.diagnosticsState)
+
+    def knownCharger(self, chargerId):
+        # OCPP allow-list: the chargers of the Wallbox account and chargers that already have devices
+        chargerId = str(chargerId)
+        if chargerId == self.DIAGNOSTICSID:
+            return False
+        return chargerId in [str(cloudId) for cloudId in self.chargerList] or chargerId in Devices
+
+    def onOcppPush(self, chargerId, status):
+        # Called on the OCPP server thread, devices are updated by wbThread
+        self.messageQueue.put(
+            {"Type":"Push",
+             "DeviceID": chargerId,
+             "Status": status
+            })
+
+    def startStopCharging(self, chargerId, command, step):
+        # Step "Start" unlocks a locked charger and schedules step "Resume" to give the charger
+        # time to process the unlock. Returns False while the command continues in step "Resume".
+        w = self.wallbox
+        chargerStatus = w.getChargerStatus(chargerId)
+        dumpJson('Status: ', chargerStatus)
+        chargingStatus = Statuses(chargerStatus["status_id"])
+        if command=='On':
+            if step == "Start" and chargingStatus == Statuses.LOCKED:
+                res=w.unlockCharger(chargerId)
+                dumpJson('Unlock: ', res)
+                self.messageQueue.putLater(
+                    {"Type":"Command",
+                     "DeviceID": chargerId,
+                     "Unit": self.DEVICESTARTSTOP,
+                     "Command": command,
+                     "Level": 0,
+                     "Step": "Resume"
+                    }, self.commandSettleTime)
+                return False
+            if chargingStatus != Statuses.CHARGING:
+                res=w.resumeChargingSession(chargerId)
+                dumpJson('Resume: ', res)
+        else:
+            if chargingStatus == Statuses.CHARGING:
+                res=w.pauseChargingSession(chargerId)
+                dumpJson('Pause: ', res)
+        return True
+
+    def applyOptimistic(self, chargerId, unit, command, level):
+        # Shows the expected result of a command right away, with the status unit marked pending.
+        # The first status update after the command settled confirms or rolls back the value.
+        chargerId = str(chargerId)
+        target = self.optimisticUnits.get(unit)
+        if target is None or chargerId not in Devices or target not in Devices[chargerId].Units:
+            return
+        if target == self.DEVICESELECTHARGINGCURRENT:
+            values = {"sValue": f"{int(round(level))}"}
+        elif unit == self.DEVICERESUME:
+            values = {"nValue": 1}
+        elif unit == self.DEVICEPAUSE:
+            values = {"nValue": 0}
+        else:
+            values = {"nValue": 0 if command == "Off" else 1}
+        with self.unitLock:
+            state = self.chargers.setdefault(chargerId, ChargerState(chargerId))
+            # Values before the first pending command, written back when a command fails
+            if target in state.pending:
+                previous = state.pending[target]["previous"]
+            else:
+                previous = state.lastWritten.get(target) or {key: getattr(Devices[chargerId].Units[target], key) for key in values}
+            state.pending[target] = {"values": values, "previous": previous, "reconcileAfter": float("inf"), "expires": time.time() + self.pendingTimeout}
+            units = {target: (values, True)}
+            status = self.pendingStatus(chargerId, state)
+            if status is not None:
+                units[self.DEVICESTATUS] = (status, True)
+            self.syncUnits(chargerId, units, state)
+
+    def pendingStatus(self, chargerId, state, sValue=None):
+        # Status unit values, marked while commands are pending
+        if self.DEVICESTATUS not in Devices[chargerId].Units:
+            return None
+        if sValue is None:
+            sValue = state.lastWritten.get(self.DEVICESTATUS, {}).get("sValue", Devices[chargerId].Units[self.DEVICESTATUS].sValue)
+        sValue = sValue.replace(self.pendingSuffix, "")
+        if state.pending:
+            sValue += self.pendingSuffix
+        return {"sValue": sValue}
+
+    def commandDone(self, chargerId, unit):
+        # The command was accepted, reconcile with the first status after the charger had time to follow
+        chargerId = str(chargerId)
+        target = self.optimisticUnits.get(unit)
+        with self.unitLock:
+            state = self.chargers.get(chargerId)
+            if state is None or target not in state.pending:
+                return
+            state.pending[target]["reconcileAfter"] = time.time() + self.commandSettleTime
+        if self.ocpp is not None and self.ocpp.isConnected(chargerId):
+            # Reconciled from the charge point's own status, not from the cloud
+            self.messageQueue.putLater(
+                {"Type":"Push",
+                 "DeviceID": chargerId
+                }, self.commandSettleTime)
+            return
+        self.messageQueue.putLater(
+            {"Type":"Update",
+             "DeviceID": chargerId
+            }, self.commandSettleTime)
+
+    def commandFailed(self, chargerId, unit):
+        # Rolls back right away, only the commanded unit and the status unit are written
+        chargerId = str(chargerId)
+        target = self.optimisticUnits.get(unit)
+        with self.unitLock:
+            state = self.chargers.get(chargerId)
+            pending = None if state is None else state.pending.pop(target, None)
+            if pending is None:
+                return
+            Domoticz.Log(f"Charger {chargerId}: command on unit {unit} failed, unit {target} rolled back")
+            units = {target: (pending["previous"], True)}
+            status = self.pendingStatus(chargerId, state)
+            if status is not None:
+                units[self.DEVICESTATUS] = (status, True)
+            self.syncUnits(chargerId, units, state)
 
     def onStart(self):
         self.debugging=False
@@ -256,6 +2262,7 @@ class WallboxPlugin:
             Domoticz.Log("onStart called")
 
         if Parameters["Mode6"] != "0":
+            setDebugLevel(int(Parameters["Mode6"]))
             Domoticz.Debugging(int(Parameters["Mode6"]))
             DumpConfigToLog()
 
@@ -265,7 +2272,7 @@ class WallboxPlugin:
         heartBeat = 10     # heartBeat can be changed in debug session
         Domoticz.Heartbeat(heartBeat)
 
-    def initDevices(self, chargerId):
+    def initDevices(self, chargerId, backfill=True):
 
         defaultUnits = [
             { #1
@@ -356,6 +2363,17 @@ class WallboxPlugin:
                           "ValueMax" : "32",
                           "ValueUnit" : "A"
                 }
+            },
+            { #14 Green energy per session, with daily history
+                "Unit": self.DEVICESESSIONGREENENERGY,
+                "Name": "Session Green Energy",
+                "Type": 243,
+                "Subtype": 33,
+                "Switchtype": 0,
+                "Options": {
+                          "DisableLogAutoUpdate" : "true",
+                          "AddDBLogEntry" : "true"
+                }
             }
         ]
         id=str(chargerId)
@@ -375,147 +2393,252 @@ class WallboxPlugin:
 
         # Domoticz Ticket created for that: https://github.com/domoticz/domoticz/issues/5809
         # Fill the device variable with the amount of energy supplied already 
-        self.fillHistoricEnergyData(chargerId)
-
-    def fillHistoricEnergyData(self, chargerId):
-        # Loads all session data, and send daily sum to Domoticz database
-        Domoticz.Debug('Fill historic data')
+        if backfill:
+            self.fillHistoricEnergyData(chargerId, fullRebuild=self.rebuildHistory)
+
+    def sessionDatabase(self):
+        if self.sessions is None:
+            self.sessions = SessionDatabase(os.path.join(Parameters["HomeFolder"], "sessions.db"))
+        return self.sessions
+
+    def downloadSessions(self, chargerId, store, database):
+        # Stores the sessions the local database is missing, one window at a time. Windows are a month,
+        # or a year while no session has been found yet. The end of every stored window is saved in the
+        # session store, so an interrupted download continues there. Sessions downloaded again are updated,
+        # so running sessions get their final energy. Returns the number of new or changed sessions,
+        # None when stopped.
+        w=self.wallbox
+        now = datetime.datetime.now()
+        lastStart = database.lastStart(chargerId)
+        changed = 0
+        windowBase = None
+        if store["syncedUntil"]:
+            startDate = datetime.datetime.fromtimestamp(store["syncedUntil"] - self.sessionOverlap)
+            # The first window ends after syncedUntil, so every window makes progress
+            windowBase = datetime.datetime.fromtimestamp(store["syncedUntil"])
+        elif lastStart:
+            startDate = datetime.datetime.fromtimestamp(lastStart)
+        else:
+            startDate = self.historyStart
+        windows = 0
+        while startDate < now:
+            if self.stopping.is_set():
+                return None
+            months = 1 if lastStart else 12
+            endDate = (windowBase or startDate).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            windowBase = None
+            for month in range(months):
+                endDate = (endDate + datetime.timedelta(days=32)).replace(day=1)
+            endDate = min(endDate, now)
+            sessionList = w.getSessionList(chargerId, startDate, endDate)
+            dumpJson('sessionList: ', sessionList, maxLength=1024)
+            inserted = database.insert(chargerId, sessionList["data"])
+            sessionList = None
+            if inserted:
+                lastStart = database.lastStart(chargerId)
+                changed += inserted
+            logDebug("Sessions charger %s %s - %s: %s new or changed", chargerId, f"{startDate:%Y-%m-%d}", f"{endDate:%Y-%m-%d}", inserted)
+            store["syncedUntil"] = endDate.timestamp()
+            try:
+                store.save()
+            except OSError as err:
+                Domoticz.Error(f"Unable to save session store {store.path}: {err}")
+            startDate = endDate
+            windows += 1
+        logDebug("Session download charger %s: %s windows", chargerId, windows)
+        return changed
+
+    def fillHistoricEnergyData(self, chargerId, fullRebuild=False):
+        # Loads the session data added since the last sync, and send daily sum to Domoticz database
+        # With fullRebuild the stored checkpoint is dropped and all sessions are loaded again
+        # Days are written to the history once a session of a later day exists, the last day stays open.
+        # The open day and the days of the download overlap are recomputed from the session database.
+        logDebug('Fill historic data')
+        store = SessionStore(Parameters["HomeFolder"], chargerId)
+        database = self.sessionDatabase()
+        if not fullRebuild and (store["sessionCount"] or store["totalEnergy"]) and not database.lastStart(chargerId):
+            Domoticz.Log(f"Session database has no sessions of charger {chargerId}, downloading all sessions")
+            fullRebuild = True
+        if fullRebuild:
+            Domoticz.Log(f"Rebuilding session history for charger {chargerId}")
+            store.reset()
+            database.clear(chargerId)
 
         if self.debugging:
             self.debugpy.breakpoint()
-        myUnit = Devices[str(chargerId)].Units[self.DEVICEENERGY]
-        message = f"Fill historic data myUnit: {myUnit}"
-        Domoticz.Debug(message) #myUnit: Unit: 7, Name: 'Session Energy', nValue: 0, sValue: '237416;0', LastUpdate: 2023-09-04 13:30:57
-        w=self.wallbox
-        endDate = datetime.datetime.now()
-        startDate = datetime.datetime(1990,1,1)
-        sessionList = w.getSessionList(chargerId, startDate, endDate)
-        Domoticz.Debug('Fill historic data Dump SessionList')
-        dumpJson('sessionList: ', sessionList)
-        currentDate=""
-        totalEnergy = 0
-        previousEnergy = 0
-
-        totalGreenEnergy = 0
-        previousGreenEnergy = 0
-        Domoticz.Debug('Fill historic data Start Processing SessionList')
-        for session in reversed(sessionList["data"]):
-            Domoticz.Debug('Start Processing SessionList (2)')
-            if session["type"]=="charger_log_session":
-                dt_object   = datetime.datetime.fromtimestamp(session["attributes"]["start"])
-                sessionDate = dt_object.strftime("%Y-%m-%d")
-                if currentDate=="":
-                    currentDate=sessionDate
-                if currentDate != sessionDate:
-                    delta=totalEnergy - previousEnergy
-                    previousEnergy = totalEnergy
-                    sValue = f"{totalEnergy};{delta};{sessionDate}"
-
-                    message = f"Fill historic data Session myUnit: {myUnit}"
-                    Domoticz.Debug(message) #myUnit: Unit: 7, Name: 'Session Energy', nValue: 0, sValue: '237416;0', LastUpdate: 2023-09-04 13:30:57
-
-                    myUnit.sValue = sValue
-                    myUnit.nValue = 0
-                    myUnit.Update(Log=True)
-                    Domoticz.Debug(f"Fill historic data Forced Updating FINISHED! nValue {myUnit.nValue} and sValue {myUnit.sValue}")
-                    sessionDate=currentDate
-
-                    deltaGreen=totalGreenEnergy - previousGreenEnergy # I want to know all about Green Historic Energy
-                    previousGreenEnergy = totalGreenEnergy            # I want to know all about Green Historic Energy
-                totalEnergy=totalEnergy+int(session["attributes"]["energy"]*1000)
-                totalGreenEnergy=totalGreenEnergy+int(session["attributes"]["green_energy"]*1000) # I want to know all about Green Historic Energy
-
-        delta=totalEnergy - previousEnergy
-        deltaGreen=totalGreenEnergy - previousGreenEnergy             # I want to know all about Green Historic Energy
-
-        sValue = f"{totalEnergy};{delta}"
-        Domoticz.Debug(f"Fill historic data: {sValue}")
-        myUnit.Update(Log=True)
+        device = Devices[str(chargerId)]
+        # Days before the open day are in the history already, except for the overlap
+        since = 0
+        if store["currentDate"]:
+            since = datetime.datetime.strptime(store["currentDate"], "%Y-%m-%d").timestamp()
+            if store["syncedUntil"]:
+                since = min(since, store["syncedUntil"] - self.sessionOverlap)
+            since = datetime.datetime.fromtimestamp(since).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        newSessions = self.downloadSessions(chargerId, store, database)
+        if newSessions is None:
+            return
+        days = database.dailyTotals(chargerId, since)
+
+        # Energy up to the first recomputed day
+        totalEnergy, totalGreenEnergy = database.totals(chargerId, 0, since)[1:]
+        energyHistory = []
+        greenHistory = []
+        sortedDays = sorted(days)
+        for day in sortedDays[:-1]:
+            energy, greenEnergy = days[day]
+            totalEnergy += energy
+            totalGreenEnergy += greenEnergy
+            energyHistory.append(f"{totalEnergy};{energy};{day}")
+            greenHistory.append(f"{totalGreenEnergy};{greenEnergy};{day}")
+        if sortedDays:
+            currentDate = sortedDays[-1]
+            store["currentDate"] = currentDate
+            store["dayEnergy"], store["dayGreenEnergy"] = days[currentDate]
+
+        for unit, history in ((self.DEVICEENERGY, energyHistory), (self.DEVICESESSIONGREENENERGY, greenHistory)):
+            if unit not in device.Units:
+                continue
+            myUnit = device.Units[unit]
+            for sValue in history:
+                myUnit.nValue = 0
+                myUnit.sValue = sValue
+                myUnit.Update(Log=True)
+        logDebug("Fill historic data: %s days written", len(energyHistory))
+
+        store["sessionCount"] = database.totals(chargerId)[0]
+        store["lastStart"] = database.lastStart(chargerId)
+        store["totalEnergy"] = totalEnergy + store["dayEnergy"]
+        store["totalGreenEnergy"] = totalGreenEnergy + store["dayGreenEnergy"]
+        logDebug("Total energy %s Total Green energy %s", store["totalEnergy"], store["totalGreenEnergy"])
+        try:
+            store.save()
+        except OSError as err:
+            Domoticz.Error(f"Unable to save session store {store.path}: {err}")
+        Domoticz.Log(f"Historic data charger {chargerId}: {newSessions} new or changed sessions, {store['sessionCount']} in total")
+        if debugEnabled():
+            for month, count, energy, greenEnergy in database.monthTotals(chargerId):
+                logDebug("Charger %s %s: %s sessions, %.1f kWh, %.0f%% green", chargerId, month, count, energy / 1000, 100 * greenEnergy / energy if energy else 0)
+        state = self.chargers.setdefault(str(chargerId), ChargerState(chargerId))
+        # Written above, compare with the units on the next poll
+        state.lastWritten.pop(self.DEVICEENERGY, None)
+        state.lastWritten.pop(self.DEVICESESSIONGREENENERGY, None)
+        state.totalEnergy = store["totalEnergy"]
+        state.totalGreenEnergy = store["totalGreenEnergy"]
+
+    def queueBackfills(self):
+        # Run this tasks for all chargers in the list.
+        if not len(self.chargerList):
+            Domoticz.Log('No charger configured.')
+            return
+        for chargerId in self.chargerList:
+            Domoticz.Log(f"Queue scheduled task for charger {chargerId} to fill historic energy data...")
+            # Processed by wbThread, keep the Domoticz heartbeat free
+            self.messageQueue.put(
+                {"Type":"Backfill",
+                 "DeviceID": str(chargerId)
+                })
 
-        Domoticz.Debug('Fill historic data Start Processing SessionList (7)')
-        Domoticz.Debug(f"Total energy {totalEnergy} Total Green energy {totalGreenEnergy}") # I want to know all about Green Historic Energy
-        self.totalEnergy = totalEnergy
-        self.totalGreenEnergy = totalGreenEnergy
+    def startJobs(self):
+        jobs = JobScheduler()
+        # Mode1 is a Python weekday (Monday 0), cron counts from Sunday
+        jobs.add("backfill", f"{self.startminute} {self.starthour} * * {(self.startday + 1) % 7}", self.queueBackfills)
+        jobs.add("metrics", self.metricsInterval, lambda: self.messageQueue.put({"Type":"Metrics"}))
+        if self.authenticated or self.chargerList:
+            jobs.add("rediscovery", self.rediscoverySchedule, lambda: self.messageQueue.put({"Type":"Discover"}))
+        if self.profiler is not None:
+            jobs.add("profile", self.profileInterval, lambda: self.messageQueue.put({"Type":"Profile"}))
+        for name in jobs.jobs:
+            logDebug("Job %s next run %s", name, datetime.datetime.fromtimestamp(jobs.nextRun(name)).strftime("%Y-%m-%d %H:%M:%S"))
+        self.jobs = jobs
+
+    def pollChargers(self, chargerIds):
+        # Status requests run in parallel on the poll pool, the devices are updated
+        # one charger at a time on this thread.
+        if self.pollPool is None or len(chargerIds) == 1:
+            for chargerId in chargerIds:
+                if self.stopping.is_set():
+                    return
+                try:
+                    self.updateDevices(chargerId)
+                except Exception as err:
+                    self.pollFailed(chargerId, err)
+            return
+        futures = {chargerId: self.pollPool.submit(self.wallbox.getChargerStatus, chargerId) for chargerId in chargerIds}
+        for chargerId, future in futures.items():
+            if self.stopping.is_set():
+                return
+            try:
+                self.updateDevices(chargerId, future.result())
+            except Exception as err:
+                self.pollFailed(chargerId, err)
 
-    def runScheduledTask(self):
-        # Run this tasks for all chargers in the list.
-        if len(self.chargerList):
-            now = datetime.datetime.now()
-            nowAsDateString = now.strftime("%Y-%m-%d")
-            # Check if it's Sunday (day 6) and the time is 03:00    
-            if nowAsDateString > self.lastRunDate and now.weekday() == self.startday and now.hour == self.starthour and now.minute == self.startminute:
-                self.lastRunDate = nowAsDateString
-                Domoticz.Log(f"Updated lastRunDate to: {nowAsDateString}")
-                for chargerId in self.chargerList:
-                    Domoticz.Log(f"Running scheduled task for charger {chargerId} to fill historic energy data...")
-                 # Charger ID to use
-                    self.fillHistoricEnergyData(chargerId)
+    def pollFailed(self, chargerId, err):
+        if isinstance(err, (CircuitOpenError, ThrottledError)):
+            logDebug("Update charger %s skipped: %s", chargerId, err)
         else:
-           Domoticz.Log('No charger configured.')
-
-    def updateDevices(self, chargerId):
-        chargerStatus = self.wallbox.getChargerStatus(chargerId)
+            Domoticz.Error(f"Update error charger {chargerId}: {err}")
+        if self.wallbox.breaker.isOpen():
+            self.markTimedOut(chargerId, 1)
+
+    def markTimedOut(self, chargerId, timedOut):
+        # Under unitLock, onCommand writes the same units from the Domoticz thread
+        with self.unitLock:
+            state = self.chargers.setdefault(chargerId, ChargerState(chargerId))
+            if state.timedOut == timedOut or chargerId not in Devices:
+                return
+            state.timedOut = timedOut
+            for myUnit in Devices[chargerId].Units.values():
+                if myUnit.TimedOut != timedOut:
+                    myUnit.TimedOut = timedOut
+                    myUnit.Update(Log=False)
+
+    def updateDevices(self, chargerId, chargerStatus=None):
+        if chargerStatus is None:
+            chargerStatus = self.wallbox.getChargerStatus(chargerId)
         dumpJson("Status: ", chargerStatus)
+        state = self.chargers.setdefault(chargerId, ChargerState(chargerId))
+        state.lastStatus = chargerStatus
+        # Desired values per unit: unit -> (values, Log)
+        units = {}
 
         ## 1: Charger Lock
-        lockStatus = "Locked" if chargerStatus["config_data"]["locked"] else "Unlocked"
-        myUnit = Devices[chargerId].Units[self.DEVICELOCK]
-        Domoticz.Debug('Current lock status: '+str(myUnit.nValue))
-        if myUnit.nValue != chargerStatus["config_data"]["locked"]:
-            myUnit.nValue = chargerStatus["config_data"]["locked"]
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Lock status changed to: ' + str(chargerStatus["config_data"]["locked"]))
+        units[self.DEVICELOCK] = ({"nValue": chargerStatus["config_data"]["locked"]}, True)
 
         ## 2: Charger status
-        myUnit = Devices[chargerId].Units[self.DEVICESTATUS]
-        chargingStatus = Statuses(chargerStatus["status_id"]).name.capitalize()
-        if myUnit.sValue != chargingStatus:
-            myUnit.sValue = chargingStatus
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Charging status changed to: ' + chargingStatus)
+        statusName = Statuses(chargerStatus["status_id"]).name
+        self.pollScheduler.observe(chargerId, statusName)
+        chargingStatus = statusName.capitalize()
+        units[self.DEVICESTATUS] = ({"sValue": chargingStatus}, True)
 
         ## 5: Charging current (This is represented in kW), not in 'A' what 'current' is.
-        myUnit = Devices[chargerId].Units[self.DEVICECURRENT]
         chargingCurrent = str(round(chargerStatus["charging_power"]*1000,1))
-        sValue = f"{chargingCurrent}"
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Charging Power changed to: ' + chargingCurrent)
+        units[self.DEVICECURRENT] = ({"sValue": f"{chargingCurrent}"}, True)
 
         ## 6: Charging stop start
-        myUnit = Devices[chargerId].Units[self.DEVICESTARTSTOP]
-        chargingCmd = 1 if chargingStatus=='CHARGING' else 0
-        if myUnit.nValue != chargingCmd:
-            myUnit.nValue = chargingCmd
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Charging status changed to: ' + str(chargingCmd))
+        chargingCmd = 1 if statusName=='CHARGING' else 0
+        units[self.DEVICESTARTSTOP] = ({"nValue": chargingCmd}, True)
 
         #added_energy
         ## 7: Energy (Counter;Usage)
-        myUnit = Devices[chargerId].Units[self.DEVICEENERGY]
         addedEnergy = int(chargerStatus["added_energy"] * 1000)
-        sValue = f"{self.totalEnergy};{addedEnergy}"
-        Domoticz.Debug('Added Energy changed to: ' + str(sValue))
         # Set counter to -1 if you can't know the counter absolute value
         # sValue must 3 semicolon separated values, the last value being a date a space and a time ("%Y-%m-%d %H:%M:%S" format) to update last days history.
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.nValue = 0
-            myUnit.Update()
-            Domoticz.Debug('Added Energy changed to: ' + str(sValue))
+        units[self.DEVICEENERGY] = ({"nValue": 0, "sValue": f"{state.totalEnergy};{addedEnergy}"}, False)
+        ## 14: Green Energy (Counter;Usage)
+        addedGreenEnergy = int(chargerStatus["added_green_energy"] * 1000)
+        units[self.DEVICESESSIONGREENENERGY] = ({"nValue": 0, "sValue": f"{state.totalGreenEnergy};{addedGreenEnergy}"}, False)
 
         ## 8: Total Energy
         # Calculate new cumulative
         myUnit = Devices[chargerId].Units[self.DEVICETOTALENERGY]
         delta = 0
-        if self.lastValue>0 and addedEnergy<self.lastValue:   # probably started new session, reset lastValue
+        if state.lastValue>0 and addedEnergy<state.lastValue:   # probably started new session, reset lastValue
             Domoticz.Log("resetting lastValue; start new session")
-            self.lastValue = 0
+            state.lastValue = 0
 
-        if addedEnergy>self.lastValue:
-            delta = addedEnergy - self.lastValue
-        self.lastValue = addedEnergy
+        if addedEnergy>state.lastValue:
+            delta = addedEnergy - state.lastValue
+        state.lastValue = addedEnergy
 
         # get current cumulative value, and increment
         sValues = myUnit.sValue.split(";")
@@ -530,16 +2653,13 @@ class WallboxPlugin:
 
         chargingCurrent = round(chargerStatus["charging_power"]*1000,1)
 
-        if self.pluginJustStarted:  # We don't want double values
-            Domoticz.Debug('First run of plugin! Caution Do not Update')
-            self.pluginJustStarted = False    # Going for round 2
+        if state.pluginJustStarted:  # We don't want double values
+            logDebug('First run of plugin! Caution Do not Update')
+            state.pluginJustStarted = False    # Going for round 2
         else: 
-            myUnit.sValue = f"{chargingCurrent};{newValue}"
-            myUnit.nValue = 0
-            myUnit.Update(Log=True)
+            units[self.DEVICETOTALENERGY] = ({"nValue": 0, "sValue": f"{chargingCurrent};{newValue}"}, True)
 
         ## 9: Device Firmware Update (included chargerID if you have multiple chargers)
-        myUnit = Devices[chargerId].Units[self.DEVICEFIRMWARE]
         updateAvailable = chargerStatus["config_data"]["software"]["updateAvailable"]
         currentVersion =  chargerStatus["config_data"]["software"]["currentVersion"]
         latestVersion =   chargerStatus["config_data"]["software"]["latestVersion"]
@@ -548,13 +2668,7 @@ class WallboxPlugin:
             sValue = f"Update Available Charger {chargerId}\nCurrent Version: {currentVersion}\nLatest Version: {latestVersion}"
         else:
             sValue = f"No Update Available Charger {chargerId}\nCurrent Version: {currentVersion}\nLatest Version: {latestVersion}"
-
-        Domoticz.Debug('Firmware DEBUG status: ' + sValue)
-
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Firmware status changed to: ' + sValue)	    
+        units[self.DEVICEFIRMWARE] = ({"sValue": sValue}, True)
 # FUN
         chargingSpeed = chargerStatus["charging_speed"]
         addedRange = chargerStatus["added_range"]
@@ -563,85 +2677,138 @@ class WallboxPlugin:
         addedGridEnergy = chargerStatus["added_grid_energy"]
         max_charging_current = chargerStatus["config_data"]["max_charging_current"]
 
-        factsMessage= f"ChargingSpeed: {chargingSpeed} AddedRange: {addedRange} AddedEnergy: {addedEnergy} AddedGreenEnergy: {addedGreenEnergy} AddedGridEnergy: {addedGridEnergy} Max Current {max_charging_current}"
-        Domoticz.Debug('Wallbox Fun Facts: ' + factsMessage)
+        logDebug("Wallbox Fun Facts: ChargingSpeed: %s AddedRange: %s AddedEnergy: %s AddedGreenEnergy: %s AddedGridEnergy: %s Max Current %s",
+                 chargingSpeed, addedRange, addedEnergy, addedGreenEnergy, addedGridEnergy, max_charging_current)
 
         lastSync = chargerStatus["last_sync"]
         statusID = chargerStatus["status_id"]
         currentMode = chargerStatus["current_mode"]
         finished = chargerStatus["finished"]
 
-        factsMessage2 = f"Last Sync: {lastSync} StatusID: {statusID} currentMode: {currentMode} Finished: {finished} Total Energy all sessions {self.totalEnergy}"
-        Domoticz.Debug('Wallbox Fun Facts: ' + factsMessage2)
+        logDebug("Wallbox Fun Facts: Last Sync: %s StatusID: %s currentMode: %s Finished: %s Total Energy all sessions %s",
+                 lastSync, statusID, currentMode, finished, state.totalEnergy)
 
-        totalcounter = self.totalEnergy + (addedEnergy * 1000)
-        factsMessage3 = f"Total Energy all sessions {self.totalEnergy} plus charged now is {addedEnergy} brings total to: {totalcounter} something to remember ?"
-        Domoticz.Debug('Wallbox Fun Facts: ' + factsMessage3)
+        totalcounter = state.totalEnergy + (addedEnergy * 1000)
+        logDebug("Wallbox Fun Facts: Total Energy all sessions %s plus charged now is %s brings total to: %s something to remember ?",
+                 state.totalEnergy, addedEnergy, totalcounter)
 # FUN
 
         ## 10: RFXCounter Total Energy Added since install
-        myUnit = Devices[chargerId].Units[self.DEVICETOTALCOUNTER]
         addedEnergy = int(chargerStatus["added_energy"] * 1000)
-        totalcounter = self.totalEnergy + addedEnergy
-        sValue = f"{totalcounter}"
-        Domoticz.Debug('Wallbox Sensor Total Energy Added since install: ' + sValue)
-
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Wallbox Added Energy counter changed to: ' + sValue)
+        totalcounter = state.totalEnergy + addedEnergy
+        units[self.DEVICETOTALCOUNTER] = ({"sValue": f"{totalcounter}"}, True)
 
         ## 11: RFXCounter Total Green Energy Added since install
-        myUnit = Devices[chargerId].Units[self.DEVICETOTALGREENCOUNTER]
         addedGreenEnergy = int(chargerStatus["added_green_energy"] * 1000)
-        totalGreencounter = self.totalGreenEnergy + addedGreenEnergy
-        sValue = f"{totalGreencounter}"
-        Domoticz.Debug('Wallbox Sensor Total Green Energy Added since install: ' + sValue)
-
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Wallbox Added Green Energy Counter changed to: ' + sValue)
+        totalGreencounter = state.totalGreenEnergy + addedGreenEnergy
+        units[self.DEVICETOTALGREENCOUNTER] = ({"sValue": f"{totalGreencounter}"}, True)
 
         ## 12: Device MAX Charging Current (A)
-        myUnit = Devices[chargerId].Units[self.DEVICEMAXCHARGINGCURRENT]
         max_charging_current = int(chargerStatus["config_data"]["max_charging_current"])
-        sValue = f"{max_charging_current}"
-        Domoticz.Debug('Wallbox Sensor MAX Charging Current: ' + sValue)
-
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Wallbox Sensor MAX Charging Current changed to: ' + sValue)
+        units[self.DEVICEMAXCHARGINGCURRENT] = ({"sValue": f"{max_charging_current}"}, True)
 
         ## 13: MAX Charging Selector
-        myUnit = Devices[chargerId].Units[self.DEVICESELECTHARGINGCURRENT]
-        max_charging_current = int(chargerStatus["config_data"]["max_charging_current"])
-        sValue = f"{max_charging_current}"
-        Domoticz.Debug('Wallbox Sensor MAX Charging Selector: ' + sValue)
-
-        if myUnit.sValue != sValue:
-            myUnit.sValue = sValue
-            myUnit.Update(Log=True)
-            Domoticz.Debug('Wallbox Sensor MAX Charging Selector changed to: ' + sValue)
+        units[self.DEVICESELECTHARGINGCURRENT] = ({"sValue": f"{max_charging_current}"}, True)
+        self.setpointWriter.confirm(chargerId, max_charging_current)
+
+        with self.unitLock:
+            # Optimistic values are kept until their command settled, then compared with the status
+            now = time.time()
+            for unit, pending in list(state.pending.items()):
+                if now < pending["reconcileAfter"] and now < pending["expires"]:
+                    units.pop(unit, None)
+                    continue
+                del state.pending[unit]
+                if unit in units and units[unit][0] != pending["values"]:
+                    Domoticz.Log(f"Charger {chargerId} did not follow the command, unit {unit} rolled back to {units[unit][0]}")
+                else:
+                    logDebug("Charger %s confirmed unit %s %s", chargerId, unit, pending["values"])
+            status = self.pendingStatus(chargerId, state, units[self.DEVICESTATUS][0]["sValue"])
+            if status is not None:
+                units[self.DEVICESTATUS] = (status, True)
+            self.syncUnits(chargerId, units)
+        self.markTimedOut(chargerId, 0)
+
+    def syncUnits(self, chargerId, units, state=None):
+        # Writes only the units whose values differ from what was last written.
+        # Unchanged liveness units are touched once per touchInterval.
+        if state is None:
+            state = self.chargers.setdefault(chargerId, ChargerState(chargerId))
+        with self.unitLock:
+            self.writeUnits(chargerId, units, state)
+
+    def writeUnits(self, chargerId, units, state):
+        device = Devices[chargerId]
+        now = time.time()
+        written = 0
+        saved = 0
+        for unit, (values, log) in units.items():
+            myUnit = device.Units[unit]
+            cached = state.lastWritten.get(unit)
+            if cached is None:
+                cached = {key: getattr(myUnit, key) for key in values}
+            if cached == values:
+                saved += 1
+                state.lastWritten[unit] = values
+                if unit in self.livenessUnits and now - state.lastTouched.get(unit, 0) >= self.touchInterval:
+                    myUnit.Touch()
+                    state.lastTouched[unit] = now
+                continue
+            for key, value in values.items():
+                setattr(myUnit, key, value)
+            updateStart = time.perf_counter()
+            myUnit.Update(Log=log)
+            self.metrics.observe("device", unit, time.perf_counter() - updateStart)
+            written += 1
+            state.lastWritten[unit] = values
+            state.lastTouched[unit] = now
+            logDebug('Unit %s changed to: %s', unit, values)
+        state.unitWrites += written
+        state.unitWritesSaved += saved
+        logDebug("Charger %s: %s unit updates, %s writes saved (total %s updates, %s saved)",
+                 chargerId, written, saved, state.unitWrites, state.unitWritesSaved)
 
     def onStop(self):
         Domoticz.Log("onStop called")
         Domoticz.Debug('onStop called - Threads still active: {} (should be 1 = {})'.format(threading.active_count(), threading.current_thread().name))
-        # signal queue thread to exit
-        self.messageQueue.put(None)
-        self.messageQueue.join()
-
-        Domoticz.Debug('Threads still active: {} (should be 1)'.format(threading.active_count()))
-        endTime = time.time() + 70
-        while (threading.active_count() > 1) and (time.time() < endTime):
-            for thread in threading.enumerate():
-                if thread.name != threading.current_thread().name:
-                    Domoticz.Debug('Thread {} is still running, waiting otherwise Domoticz will abort on plugin exit.'.format(thread.name))
-            time.sleep(1.0)
+        deadline = time.time() + self.stopTimeout
+        # Cancel everything that is pending, only the message in progress is finished
+        self.stopping.set()
+        dropped = self.messageQueue.close()
+        if dropped:
+            Domoticz.Log(f"Stopping: {dropped} queued messages dropped")
+        wallbox = getattr(self, "wallbox", None)
+        if wallbox is not None:
+            wallbox.cancel()
+        if self.pollPool is not None:
+            self.pollPool.shutdown(wait=False, cancel_futures=True)
+        if self.transport is not None:
+            self.transport.abort()     # Requests in flight fail now instead of at their read timeout
+        if self.ocpp is not None:
+            self.ocpp.stop(timeout=max(deadline - time.time(), 0.1))
+        messageThread = getattr(self, "messageThread", None)
+        if messageThread is not None:
+            messageThread.join(max(deadline - time.time(), 0))
+
+        for thread in self.pluginThreads():
+            thread.join(max(deadline - time.time(), 0))
+        running = [thread.name for thread in self.pluginThreads()]
+        if running:
+            Domoticz.Error(f"Threads still running after {self.stopTimeout}s: {', '.join(running)}")
+        elif self.sessions is not None:
+            self.sessions.close()
+        if self.recorder is not None and not running:
+            self.recorder.close()
+        if self.profiler is not None and not running:
+            self.profiler.stop()
 
         Domoticz.Debug('Plugin stopped - Threads still active: {} (should be 1)'.format(threading.active_count()))
 
+    def pluginThreads(self):
+        # Threads started by the plugin, other threads (e.g. debugpy) are not waited for
+        return [thread for thread in threading.enumerate()
+                if thread is not threading.current_thread() and thread.name.startswith(self.threadNames)]
+
     def onConnect(self, Connection, Status, Description):
         Domoticz.Debug('onConnect called ({}) with status={}'.format(Connection.Name, Status))        
         Domoticz.Log("onConnect called")
@@ -652,6 +2819,15 @@ class WallboxPlugin:
 
     def onCommand(self, DeviceID, Unit, Command, Level, Color):
         Domoticz.Log("onCommand called for Device " + str(DeviceID) + " Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
+        if DeviceID == self.DIAGNOSTICSID:
+            if Unit == self.DIAGPROFILE:
+                self.messageQueue.put({"Type":"Profile"})
+            return
+        self.pollScheduler.commandSent(DeviceID)
+        self.applyOptimistic(DeviceID, Unit, Command, Level)
+        if Unit == self.DEVICESELECTHARGINGCURRENT:
+            self.setpointWriter.request(DeviceID, Unit, Command, Level)
+            return
         self.messageQueue.put(
             {"Type":"Command", 
              "DeviceID": DeviceID,
@@ -668,15 +2844,17 @@ class WallboxPlugin:
         Domoticz.Log("onDisconnect called")
 
     def onHeartbeat(self):
-        self.countDown = self.countDown-1
-        Domoticz.Debug(f"onHeartbeat called {self.countDown}")
-        if self.countDown <= 0:
-            self.countDown = self.countDownInit
+        Domoticz.Debug("onHeartbeat called")
+        now = time.time()
+        if self.jobs is not None:
+            self.jobs.runDue(now)
+        for chargerId in self.pollScheduler.due(now):
+            if self.ocpp is not None and self.ocpp.isConnected(chargerId):
+                continue        # Pushed by the charge point
             self.messageQueue.put(
-                {"Type":"Update", 
+                {"Type":"Update",
+                 "DeviceID": chargerId
                 })
-        # Check for the scheduled task
-        self.runScheduledTask()
 
 global _plugin
 _plugin = WallboxPlugin()
@@ -785,20 +2963,3 @@ def statusAsLevelSwitch(self):
         myUnit.sValue = level
         myUnit.Update(Log=True)
         Domoticz.Debug('Charging status changed to: ' + level)
-
-#UPDATE THE DEVICE
-def UpdateDevice(AlwaysUpdate, Devices, Unit, nValue, sValue, **kwargs):
-    Updated = False
-    if Unit in Devices:
-        kwargs = { key : value for key, value in kwargs.items() if value != getattr(Devices[Unit], key, None) }
-        default_kwargs = { 'TimedOut': 0 }
-        kwargs = { **default_kwargs, **kwargs }
-        if AlwaysUpdate or Devices[Unit].nValue != int(nValue) or Devices[Unit].sValue != str(sValue) or Devices[Unit].TimedOut != kwargs['TimedOut'] or len(kwargs)>1:
-            Domoticz.Debug('Update {}: nValue {} - sValue {} - Other: {}'.format(Devices[Unit].Name, nValue, sValue, kwargs))
-            Devices[Unit].Update(nValue=int(nValue), sValue=str(sValue), **kwargs)
-            Updated = True
-        else:
-            if not kwargs.get('TimedOut', 0):
-                Devices[Unit].Touch()
-    return Updated
-